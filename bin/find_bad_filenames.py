@@ -8,30 +8,89 @@
 #
 #------------------------------------------------------------
 
-import os.path
+import sys
 
+from cirosantilli import argparse_extras
 from cirosantilli import files
-from cirosantilli.files import FORBIDDEN_BASENAME_CHARS, MAX_BNAME_LENGTH
+from cirosantilli import filename_rules
 
 if __name__ == '__main__':
 
-    for path in files.find(u'.'):
-        head, bname = os.path.split(path)
-        bname_noext, ext = os.path.splitext(bname)
-        for c in FORBIDDEN_BASENAME_CHARS:
-            if c in bname:
-                print path
-                print "forbidden char: '%s' decimal: %d" % (c,ord(c))
-                print
-        if len(bname) > MAX_BNAME_LENGTH:
-            print path
-            print "basename longer than %d" % MAX_BNAME_LENGTH
-            print
-        if bname[0] == '-':
-            print path
-            print "basename starts with a hyphen '-'"
-            print
-        if bname_noext[-1] == '.':
-            print path
-            print "basename without extension ends in a dot '.'"
-            print
+    rule_names = [ rule.name for rule in
+            filename_rules.DEFAULT_RULES + filename_rules.PORTABILITY_RULES ]
+
+    parser = argparse_extras.ArgumentParser(
+        description="finds paths under the current directory whose basenames follow bad naming practices",
+        epilog="""rules: %s
+
+EXAMPLES
+
+    %%(f)s
+
+        prints each bad path followed by what is wrong with it
+
+    %%(f)s -r forbidden_char -r too_long -f null -j 8
+
+        only checks those rules, listing directories with 8 threads,
+        and outputs rule, detail and path null terminated
+
+    %%(f)s -p -l 200
+
+        before syncing to windows or macos: also checks windows rules,
+        siblings that differ only in case or unicode normalization,
+        and paths of 200 characters or more
+""" % ', '.join(rule_names))
+
+    parser.add_argument('-r', '--rule',
+        action='append',
+        choices=rule_names,
+        default=None,
+        help="rule to check. can be given multiple times. default: all, "
+            "except windows_* which require -p",
+    )
+
+    parser.add_argument('-p', '--portability',
+        action='store_true',
+        default=False,
+        help="also checks windows rules, case and unicode normalization collisions "
+            "between siblings, and path lengths. -j is not used",
+    )
+
+    parser.add_argument('-l', '--max-path-length',
+        type=int,
+        default=filename_rules.WINDOWS_MAX_PATH,
+        help="with -p, paths of this many characters or more are reported. default: %(default)s",
+    )
+
+    parser.add_argument('-f', '--format',
+        choices=filename_rules.OUTPUT_FORMATS,
+        default='text',
+        help="output format. see filename_rules.format_problem. default: text",
+    )
+
+    parser.add_argument('-j', '--workers',
+        type=int,
+        default=1,
+        help="number of threads used to list directories. default: 1",
+    )
+
+    args = parser.parse_args()
+
+    rules = filename_rules.DEFAULT_RULES
+    if args.portability:
+        rules = rules + filename_rules.PORTABILITY_RULES
+    if args.rule:
+        rules = [ rule for rule in rules if rule.name in args.rule ]
+    checker = filename_rules.BasenameChecker(rules)
+
+    if args.portability:
+        problems = filename_rules.audit_tree(u'.', checker, args.max_path_length)
+    else:
+        problems = ( (entry.path, rule_name, detail)
+                for entry in files.find_entries(u'.', workers=args.workers, ordered=True)
+                for rule_name, detail in checker.problems(entry.name) )
+
+    encoding = 'utf-8'
+    for path, rule_name, detail in problems:
+        sys.stdout.write(
+            filename_rules.format_problem(args.format, path, rule_name, detail).encode(encoding))
@@ -3,12 +3,12 @@
 import re
 import sys
 import os
-import itertools
 
 import termcolor
 
 from cirosantilli import files
 from cirosantilli import argparse_extras
+from cirosantilli import utils
 
 if __name__ == '__main__':
 
@@ -82,6 +82,21 @@ TODO
         help="max search depth. 1 limits search to current dir",
     )
 
+    parser.add_argument('-x','--index',
+        default=None,
+        action='store',
+        help="path of a files.TreeIndex database of the current dir. "
+            "created if missing, and updated before searching, which only lists "
+            "directories modified since the last search",
+    )
+
+    parser.add_argument('-j','--workers',
+        default=1,
+        action='store',
+        type=int,
+        help="number of threads used to list directories. speeds up search on network filesystems",
+    )
+
     parser.add_argument('-n','--negated',
         default=[],
         action='append',
@@ -115,8 +130,11 @@ TODO
 
     min_depth = args.min_depth
     max_depth = args.max_depth
-    res = map(lambda r: re.compile( unicode(r, sys.stdin.encoding), re_args), args.find)
-    negated_res = map(lambda r: re.compile( unicode(r, sys.stdin.encoding), re_args), args.negated)
+    matcher = utils.RegexAllMatcher(
+        [ unicode(r, sys.stdin.encoding) for r in args.find ],
+        [ unicode(r, sys.stdin.encoding) for r in args.negated ],
+        re_args,
+    )
 
     if args.null_separated_output:
         output_separator = u"\0"
@@ -132,62 +150,45 @@ TODO
 
     encoding = 'utf-8' #TODO make encoding option
 
+    index = None
+    if args.index:
+        index = files.TreeIndex(args.index, u".")
+        index.update()
+
     #act
     stdout_isatty = sys.stdout.isatty()
-    for path in files.find(
+    #escape sequences that start and end the color of matches
+    color_start, color_end = termcolor.colored(u'\0', 'red', 'on_blue', attrs=['bold']).split(u'\0')
+    #lines are written in blocks of about OUTPUT_BUFSIZE bytes, not one write per line
+    OUTPUT_BUFSIZE = 2**16
+    output = []
+    output_size = 0
+    for entry in files.find_entries(
                 u".",
                 min_depth=min_depth,
                 max_depth=max_depth,
+                workers=args.workers,
+                index=index,
             ):
 
-        isfile = os.path.isfile(path)
+        path = entry.path
+        isfile = entry.is_file()
         if ( isfile and select_files ) or ( not isfile and select_dirs ):
 
-            #initialize
             head, bname = os.path.split(path)
-            accept=True
-            color_spans = [] #start end pairs span pairs to color in between
-
-            #find those that match
-            for reg in res:
-                if stdout_isatty: #must find all matches to color them later
-                    matches = list(reg.finditer(bname))
-                    if matches:
-                        color_spans.extend(m.span() for m in matches)
-                    else:
-                        accept = False
-                        break
-                else: #pipe: no coloring, so only find one match
-                    if not reg.search(bname):
-                        accept = False
-                        break
-
-            #don't take if a negation matches
-            if accept:
-                for reg in negated_res:
-                    if reg.search(bname):
-                        accept = False
-                        break
 
             #print
-            if accept:
-                sys.stdout.write( (head + os.path.sep).encode(encoding) )
+            if matcher.accepts(bname):
                 if stdout_isatty: #color
-                    for i,c in itertools.izip(itertools.count(),bname): 
-                        printed = False
-                        for color_span in color_spans:
-                            if i >= color_span[0] and i < color_span[1]:
-                                termcolor.cprint(
-                                    c,
-                                    'red',
-                                    'on_blue',
-                                    attrs=['bold'],
-                                    end=''
-                                )
-                                printed = True
-                                break;
-                        if not printed:
-                            sys.stdout.write( c.encode(encoding) )
-                else: #don't color: may break grep, etc, since terminal color means extra control chars
-                    sys.stdout.write( bname.encode(encoding) )
-                sys.stdout.write( output_separator )
+                    bname = utils.highlight_spans(bname, matcher.spans(bname), color_start, color_end)
+                #else don't color: may break grep, etc, since terminal color means extra control chars
+                line = ( head + os.path.sep + bname + output_separator ).encode(encoding)
+                output.append(line)
+                output_size += len(line)
+                if output_size >= OUTPUT_BUFSIZE:
+                    sys.stdout.write(''.join(output))
+                    output = []
+                    output_size = 0
+
+    sys.stdout.write(''.join(output))
+    sys.stdout.flush()
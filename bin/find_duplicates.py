@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+
+import sys
+
+from cirosantilli import argparse_extras
+from cirosantilli import duplicates
+from cirosantilli import files
+from cirosantilli import hashing
+
+if __name__ == '__main__':
+
+    parser = argparse_extras.ArgumentParser(
+        description="finds files with identical contents",
+        epilog="""files are first grouped by size, then by a hash of their first bytes,
+and only files that still collide are hashed entirely.
+
+hardlinks to a same file are not duplicates: only one path is output per inode.
+symlinks are not followed.
+
+EXAMPLES
+
+    %(f)s
+
+        finds duplicates under the current directory.
+        outputs one path per line, groups separated by an empty line.
+
+    %(f)s -f null a b | xargs -0 ...
+
+        finds duplicates across directories a and b,
+        and outputs size, digest and path of each file, null terminated.
+""")
+
+    parser.add_argument('roots',
+        nargs='*',
+        default=['.'],
+        help="directories to search. default: current directory",
+    )
+
+    parser.add_argument('-a', '--algorithm',
+        default='sha1',
+        help="hash algorithm. see hashing.new_hash. default: sha1",
+    )
+
+    parser.add_argument('-p', '--partial-size',
+        type=int,
+        default=duplicates.PARTIAL_SIZE,
+        help="number of bytes of the partial hash. default: %(default)s",
+    )
+
+    parser.add_argument('-m', '--min-size',
+        type=int,
+        default=1,
+        help="ignore files smaller than this. default: %(default)s, which ignores empty files",
+    )
+
+    parser.add_argument('-j', '--workers',
+        type=int,
+        default=1,
+        help="number of files hashed in parallel. default: 1",
+    )
+
+    parser.add_argument('-c', '--cache',
+        default=None,
+        help="path of a HashCache database to reuse hashes of unchanged files",
+    )
+
+    parser.add_argument('-f', '--format',
+        choices=duplicates.OUTPUT_FORMATS,
+        default='text',
+        help="output format. see duplicates.format_group. default: text",
+    )
+
+    args = parser.parse_args()
+
+    try:
+        hashing.new_hash(args.algorithm)
+    except ValueError, e:
+        parser.error(str(e))
+
+    cache = hashing.HashCache(args.cache) if args.cache else None
+    entries = ( entry for root in args.roots
+            for entry in files.find_entries(root, type='f', ordered=True, follow_links=False) )
+    try:
+        for group in duplicates.find_duplicates(
+                entries,
+                algorithm=args.algorithm,
+                partial_size=args.partial_size,
+                min_size=args.min_size,
+                workers=args.workers,
+                cache=cache):
+            sys.stdout.write(duplicates.format_group(args.format, group))
+    finally:
+        if cache is not None:
+            cache.close()
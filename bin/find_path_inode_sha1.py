@@ -12,36 +12,14 @@
 #
 #------------------------------------------------------------
 
-import os
-import os.path
-import stat
-import hashlib
 import sys
 
+from cirosantilli import files
+from cirosantilli import hashing
+
 KBYTE = 2**10
 SHA1_MAX_BYTES_READ_DEFAULT = 100*KBYTE
 
-def sha1_hex_file(filepath, max_bytes=None):
-    """
-    Returns the SHA1 of a given filepath in hexadecimal.
-
-    Opt-args:
-
-    * max_bytes. If given, reads at most max_bytes bytes from the file.
-    """
-
-    sha1 = hashlib.sha1()
-    f = open(filepath, 'rb')
-    try:
-        if max_bytes:
-            data = f.read(max_bytes)
-        else:
-            data = f.read()
-        sha1.update(data)
-    finally:
-        f.close()
-    return sha1.hexdigest()
-
 if __name__ == '__main__':
 
 
@@ -55,8 +33,8 @@ Useful to make a backup of filepaths before renaming them, for example before a
         )
 
     parser.add_argument('-n', '--sha1-max-nbytes',
-        nargs=1,
         action="store", 
+        type=int,
         dest="sha1_max_bytes_read_default",
         default=SHA1_MAX_BYTES_READ_DEFAULT,
         help='Maximun number of bytes to read to calculate SHA1 checksum.'+
@@ -68,34 +46,39 @@ Useful to make a backup of filepaths before renaming them, for example before a
         default=False, 
         help='a is False if not present')
 
+    hashing.add_hash_arguments(parser)
+
     args = parser.parse_args(sys.argv[1:])
     sha1_max_bytes_read = args.sha1_max_bytes_read_default
     write_output_to_file = args.write_output_to_file
+    try:
+        hasher, cache = hashing.file_hasher_from_args(args, sha1_max_bytes_read)
+    except ValueError, e:
+        parser.error(str(e))
 
     file_output = ""
 
-    print "sha1_max_bytes_read"
-    print sha1_max_bytes_read
-    print
-
-    paths = []
-    for root, dirs, files in os.walk('.'):
-        for bname in files:
-            paths.append(os.path.join(root,bname))
-    paths.sort()
-
-    for path in paths:
-        print path
-        print str(os.stat(path)[stat.ST_INO])
-        print str(sha1_hex_file(path,sha1_max_bytes_read))
+    if args.format == 'text':
+        print "sha1_max_bytes_read"
+        print sha1_max_bytes_read
         print
 
-
-
-
-
-
-
-
-
-
+    #files are found while they are hashed, in the order of their sorted paths.
+    #as with os.walk, symlinks to files are hashed, and symlinks to dirs are not followed
+    entries = ( entry for entry in
+            files.find_entries('.', ordered=True, follow_links=False) if entry.is_file() )
+    results = hashing.hash_paths(
+        entries,
+        lambda entry: hasher(entry.path),
+        workers=args.workers,
+    )
+    for entry, digest, error in results:
+        if error is not None:
+            sys.stderr.write(str(error) + "\n")
+            continue
+        #the inode of the file, not of the symlink to it, as os.stat
+        inode = entry.stat().st_ino if entry.is_symlink() else entry.inode()
+        sys.stdout.write(hashing.format_hash_record(args.format, entry.path, digest, inode))
+
+    if cache is not None:
+        hashing.report_mismatches(cache)
@@ -12,34 +12,12 @@
 #
 #------------------------------------------------------------
 
-import os
-import os.path
-import stat
-import hashlib
 import sys
 
-SHA1_MAX_BYTES_READ_DEFAULT = float("inf") # defaults to read entire file
-
-def sha1_hex_file(filepath, max_bytes=None):
-    """
-    Returns the SHA1 of a given filepath in hexadecimal.
-
-    Opt-args:
+from cirosantilli import files
+from cirosantilli import hashing
 
-    * max_bytes. If given, reads at most max_bytes bytes from the file.
-    """
-
-    sha1 = hashlib.sha1()
-    f = open(filepath, 'rb')
-    try:
-        if max_bytes:
-            data = f.read(max_bytes)
-        else:
-            data = f.read()
-        sha1.update(data)
-    finally:
-        f.close()
-    return sha1.hexdigest()
+SHA1_MAX_BYTES_READ_DEFAULT = float("inf") # defaults to read entire file
 
 if __name__ == '__main__':
 
@@ -55,9 +33,12 @@ SAMPLE CALLS
 find_path_sha1.py
 #finds, calculates sha1 based on the entire files, and prints path\nsha1 to stdout.
 
-find_path_sha1.py -n 100000
+find_path_sha1.py -m 100000
 #finds, calculates sha1 based on 100000 bytes
 
+find_path_sha1.py -a sha256 -s 65536
+#sha256 fingerprint of the size, first and last 65536 bytes of each file
+
 """,
         epilog="Report any bugs to ciro.santilli@gmail.com", 
         prog='Program')
@@ -70,32 +51,31 @@ find_path_sha1.py -n 100000
         help='Maximum number of bytes to read to calculate SHA1 checksum.'+
             'Reading the whole file might be too slow, and unnecessary for some applications.')
 
+    hashing.add_hash_arguments(parser)
+
     args = parser.parse_args(sys.argv[1:])
     sha1_max_bytes_read = args.sha1_max_bytes_read
+    try:
+        hasher, cache = hashing.file_hasher_from_args(args, sha1_max_bytes_read)
+    except ValueError, e:
+        parser.error(str(e))
 
     file_output = ""
 
-    print "sha1_max_bytes_read"
-    print sha1_max_bytes_read
-    print
-
-    paths = []
-    for root, dirs, files in os.walk('.'):
-        for bname in files:
-            paths.append(os.path.join(root,bname))
-    paths.sort()
-
-    for path in paths:
-        print path
-        print str(sha1_hex_file(path,sha1_max_bytes_read))
+    if args.format == 'text':
+        print "sha1_max_bytes_read"
+        print sha1_max_bytes_read
         print
 
-
-
-
-
-
-
-
-
-
+    #files are found while they are hashed, in the order of their sorted paths.
+    #as with os.walk, symlinks to files are hashed, and symlinks to dirs are not followed
+    paths = ( entry.path for entry in
+            files.find_entries('.', ordered=True, follow_links=False) if entry.is_file() )
+    for path, digest, error in hashing.hash_paths(paths, hasher, workers=args.workers):
+        if error is not None:
+            sys.stderr.write(str(error) + "\n")
+            continue
+        sys.stdout.write(hashing.format_hash_record(args.format, path, digest))
+
+    if cache is not None:
+        hashing.report_mismatches(cache)
@@ -1,107 +1,83 @@
 #!/usr/bin/env python
 
-from cirosantilli import files
 import os
-import json
-
-class Item:
-
-    def __init__(self,relpath,inode):
-        self.relpath = relpath
-        self.inode = inode
-        
-    def serialize(self):
-        return relpath + '\n' + inode
-    
-    def deserialize(self, serialized):
-        splited = serialized.split('\n')
-        relpath = splited[0]
-        inode = splited[1]
-        return File(relpath,inode)
-    
-class DB:
-    
-    DB_NAME = '.iresolve'
-    
-    def __init__(self, items=[]):
-        self.items = items
-        
-    def add_item(self, item):
-        self.items.append(item)
-        
-    def add_items(self, items):
-        self.items.extend(items)
-
-    @staticmethod
-    def update(dbdir):
-        """
-        Creates the relative path/inode database in given directory.
-        
-        If it already exists, erases the old one, and creates the new one.
-        """
-        
-        # create database in memory
-        dbpath = os.path.join(dbdir,DBNAME)
-        if os.path.exists(dbpath):
-            db = DB.deserialize(files.read(dbpath))
-        else:
-            db = db()
-        
-        inodes = db.get_inodes()
-        relpaths = db.get_relpaths()
-        for relpath in relpaths:
-            path = os.path.join(dbdir,relpath)
-            if( not os.path.exists(path) ):
-                db.update_inode_path(inode,path)
-        
-        # get files under
-        exists, file_paths = files.find(r'./',
-            type='f',
-            fulltree=True,
-            
-        
-        for path in file_paths:
-            db.add_item(paths.append(path),files.inode(path))
-        
-        files.write(dbpath,db.serialize())
-    
-    def update_inode_path(self,inode,path):
-    
-    def clear(self):
-        self.items = []
-        
-    def serialize(self,dbpath):
-        
-        json_items = []
-        for item in self.items:
-            json_items.append(item.serialize())
-        
-        json_db = json.dumps(json_items)
-        return json_db
-    
-    @staticmethod
-    def deserialize(serialized):
-        
-        items = []
-        json_items = json.loads(serialized)
-        for json_item in json_items:
-            items.append(object)
-    
-        splited = serialized.split(SPLIT_SEQ)
-        for item in self.items: 
-            output = output + item.serialize + '\n'
-        return db
+import sys
+
+from cirosantilli import argparse_extras
+from cirosantilli import files
+
+DB_NAME = '.iresolve'
 
 if __name__ == '__main__':
-    
-    DB.update(os.getcwd())
 
+    parser = argparse_extras.ArgumentParser(
+        description="keeps a database of the paths and inodes of all files under a directory",
+        epilog="""the database is a files.TreeIndex stored in a %(db)s file
+at the root of the indexed directory. updates only list directories that changed.
+
+EXAMPLES
+
+    %(f)s update
+
+        creates or updates the database of the current directory
+
+    %(f)s update; move_regex.py ...; %(f)s update; find . -name '*.bak' | %(f)s resolve
+
+        finds where the given paths went after the renames
+
+    %(f)s inode 1234
+
+        prints the paths with inode 1234
+
+    %(f)s path a/b
 
+        prints the inode of a/b
+""" % {'db': DB_NAME, 'f': '%(f)s'})
 
+    parser.add_argument('-d', '--db-dir',
+        default=os.curdir,
+        help="directory that is indexed and contains the database. default: current directory",
+    )
 
+    parser.add_argument('action',
+        choices=['update', 'inode', 'path', 'resolve', 'compact'],
+        help="""update: brings the database up to date.
+inode: prints the paths of the given inodes.
+path: prints the inodes of the given paths.
+resolve: prints the current paths of files that were at the given paths at a previous update.
+compact: forgets removed files and shrinks the database""",
+    )
 
+    parser.add_argument('args',
+        nargs='*',
+        help="inodes or paths. if none, they are read from stdin, one per line",
+    )
 
+    args = parser.parse_args()
 
+    index = files.TreeIndex(os.path.join(args.db_dir, DB_NAME), args.db_dir)
+    items = args.args or argparse_extras.iter_stdin_items('\n')
 
+    def output(path):
+        return os.path.relpath(path).encode(sys.getfilesystemencoding())
 
+    if args.action == 'update':
+        index.update()
+    elif args.action == 'compact':
+        index.compact()
+    elif args.action == 'inode':
+        for ino in items:
+            for path in index.paths_of_inode(int(ino)):
+                print output(path)
+    elif args.action == 'path':
+        for path in items:
+            inode = index.inode_of(path)
+            print inode[0] if inode is not None else ''
+    else:
+        for path in items:
+            print path
+            for new_path in index.resolve(path):
+                print output(new_path)
+            print
 
+    index.close()
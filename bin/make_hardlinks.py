@@ -2,25 +2,68 @@
 
 import os
 import argparse
+import logging
+import sys
+
 from files import make_hardlinks
 
 '''Command line input: "src1" "src2" "src3 ... srcn dest_dir , and then applies make_make_hardlinks([src1,src2,src3,...srcn],dest_dir)'''
 if __name__ == '__main__':
-    
-    parser = argparse.ArgumentParser(description='Creates hardlinks of all given paths to destination folder with the same name as the original name.')
-    parser.add_argument('source_paths', nargs='+', help='Source of all hardlinks to be made.')
-    parser.add_argument('destination_dir', help='Destination directory of all hardlinks.')
-    
-    args = parser.parse_args()
-    
-    make_hardlinks(args.source_paths,args.destination_dir)
 
+    parser = argparse.ArgumentParser(description='Creates hardlinks of all given paths to destination folder with the same name as the original name.',
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="""DEDUPE MODE
+
+With -d, replaces duplicate files by hardlinks to a single copy instead.
+The paths are then the directories in which to look for duplicates.
+If no path is given, the duplicate groups are read from stdin in the
+null format output by `find_duplicates.py -f null`.
 
+Files are compared byte by byte before being linked, replaced atomically,
+and only linked to files of the same filesystem. The oldest file of each
+group is kept. The number of bytes reclaimed is printed at the end.
 
+    make_hardlinks.py -d -n music
 
+        shows what would be linked under music, and how much space it would save
+
+    find_duplicates.py -f null -j 4 a b | make_hardlinks.py -d
+""")
+    parser.add_argument('paths', nargs='*', help='Sources of all hardlinks to be made, followed by the destination directory of all hardlinks.')
+    parser.add_argument('-d', '--dedupe', action='store_true', default=False, help='Replace duplicate files by hardlinks. See below.')
+    parser.add_argument('-n', '--dry-run', action='store_true', default=False, help='In dedupe mode, only show what would be linked.')
+    parser.add_argument('-j', '--workers', type=int, default=1, help='In dedupe mode, number of files hashed in parallel.')
+
+    args = parser.parse_args()
 
+    if not args.dedupe:
+        if len(args.paths) < 2:
+            parser.error('at least one source path and the destination directory are needed')
+        make_hardlinks(args.paths[:-1],args.paths[-1])
+        sys.exit(0)
 
+    import argparse_extras
+    import duplicates
+    import files
 
+    logging.basicConfig(format='%(message)s', level=logging.INFO)
 
+    if args.paths:
+        entries = ( entry for root in args.paths
+                for entry in files.find_entries(root, type='f', ordered=True, follow_links=False) )
+        groups = duplicates.find_duplicates(entries, workers=args.workers)
+    else:
+        groups = duplicates.parse_null_records(argparse_extras.iter_stdin_items('\0'))
 
+    reclaimed, errors = files.dedupe_hardlinks(groups, dry_run=args.dry_run)
 
+    if errors:
+        logging.error("ERRORS")
+        logging.error("\n".join(errors))
+        logging.error("END ERRORS\n")
+    if args.dry_run:
+        print "bytes that would be reclaimed: %d" % reclaimed
+    else:
+        print "bytes reclaimed: %d" % reclaimed
+    if errors:
+        sys.exit(1)
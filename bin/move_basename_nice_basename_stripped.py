@@ -3,13 +3,12 @@
 import os
 
 from cirosantilli.move_argparse import move_argparse
-from cirosantilli import utils
 from cirosantilli import files
 
 if __name__ == '__main__':
 
     move_argparse(
-            files.act_basename_only(utils.nice_basename_stripped),
+            files.act_basename_only(files.nice_basename_stripped),
             description="corrects filenames that are forbidden" \
                 "or highly unadvisable on Linux/Windows/Mac by stripping bad things if possible",
             epilog="""EXAMPLES
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+
+import logging
+import os
+import sys
+
+from cirosantilli import argparse_extras
+from cirosantilli.move_argparse import GitMvBatch, MANIFEST_DEFAULT
+from cirosantilli.move_plan import resume_move, rollback_move, undo_move
+
+if __name__ == '__main__':
+
+    parser = argparse_extras.ArgumentParser(
+        description="resumes or rolls back a batch of renames from its journal, "
+            "or undoes it from its manifest",
+        epilog="""journals are written by the move_argparse tools such as move_regex.py
+when given the -J option.
+
+EXAMPLES
+
+    %(f)s resume renames.journal
+
+        does the renames which had not been done when the batch was interrupted
+
+    %(f)s rollback renames.journal
+
+        undoes the renames which had been done, last first.
+        rolling back twice redoes the renames.
+
+    %(f)s undo
+
+        undoes the last batch of renames done with -D, from its manifest.
+        files whose inode changed since they were renamed are not touched.
+        undoing twice redoes the renames.
+""")
+
+    argparse_extras.add_log_level(parser)
+
+    parser.add_argument(
+        '-g',
+        '--git-mv',
+        action='store_true',
+        default=False,
+        help='if given does a git mv rename instead of normal rename',
+    )
+
+    parser.add_argument('action',
+        choices=['resume', 'rollback', 'undo'],
+        help="what to do with the journal or manifest",
+    )
+
+    parser.add_argument('journal',
+        nargs='?',
+        default=None,
+        help="path of the journal, or of the manifest for undo. "
+            "the manifest defaults to " + MANIFEST_DEFAULT.replace('%', '%%'),
+    )
+
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        format='%(message)s',
+        level=args.log_level,
+    )
+
+    kwargs = {}
+    if args.git_mv:
+        kwargs['mv_func'] = GitMvBatch()
+
+    if args.action == 'undo':
+        errors = undo_move(os.path.expanduser(args.journal or MANIFEST_DEFAULT), **kwargs)
+    elif args.journal is None:
+        parser.error("the journal is required for " + args.action)
+    elif args.action == 'resume':
+        errors = resume_move(args.journal, **kwargs)
+    else:
+        errors = rollback_move(args.journal, **kwargs)
+
+    if errors:
+        logging.error("ERRORS")
+        logging.error("\n".join(errors))
+        logging.error("END ERRORS\n")
+        sys.exit(1)
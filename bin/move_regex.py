@@ -1,5 +1,6 @@
 #!/usr/bin/env python
 
+import os.path
 import re
 
 from cirosantilli.move_argparse import move_argparse
@@ -32,6 +33,56 @@ def controller(args):
         }
     )
     
+def re_flags(ignorecase=True):
+    re_args = re.UNICODE
+    if ignorecase:
+        re_args = re_args | re.IGNORECASE
+    return re_args
+
+class RegexRenamePlan(object):
+    """
+    Precompiled regex rename function.
+
+    Holds the compiled find regex, its flags and the basename/extension mode,
+    and does in a single call what rename_func decorated by act_noext_only
+    and act_basename_only does, without the intermediate calls.
+
+    Returns the new basename only, unless act_full_path is True.
+
+    >>> plan = RegexRenamePlan('a', 'b', act_on_extension=False)
+    >>> print plan('/a/a.a')
+    b.a
+    >>> plan = RegexRenamePlan('a', 'b', act_full_path=True)
+    >>> print plan('/a/a.a')
+    /b/b.b
+    """
+
+    def __init__(self, find_str, replace_str, ignorecase=True,
+            act_on_extension=True, act_full_path=False):
+        self.flags = re_flags(ignorecase)
+        self.find_re = re.compile(find_str, self.flags)
+        self.replace_str = replace_str
+        self.act_on_extension = act_on_extension
+        self.act_full_path = act_full_path
+
+    def __call__(self, path):
+        if not self.act_full_path:
+            path = path[path.rfind(os.path.sep)+1:]
+        if self.act_on_extension:
+            return self.find_re.sub(self.replace_str, path)
+        path_noext, ext = os.path.splitext(path)
+        return self.find_re.sub(self.replace_str, path_noext) + ext
+
+def rename_func_factory(args):
+    return RegexRenamePlan(
+        args.find[0],
+        args.replace[0],
+        ignorecase=args.ignorecase,
+        act_on_extension=args.act_on_extension,
+        act_full_path=args.act_full_path,
+    )
+
+_find_re_cache = {}
 def rename_func(path,*args,**kwargs):
 
     find_str = args[0]
@@ -39,11 +90,10 @@ def rename_func(path,*args,**kwargs):
 
     ignorecase = kwargs.get('ignorecase',True)
 
-    re_args = re.UNICODE
-    if ignorecase:
-        re_args = re_args | re.IGNORECASE
-
-    find_re = re.compile(find_str,re_args)
+    key = (find_str, ignorecase)
+    find_re = _find_re_cache.get(key)
+    if find_re is None:
+        find_re = _find_re_cache[key] = re.compile(find_str,re_flags(ignorecase))
 
     return utils.resub((find_re,replace_str),path)
 
@@ -51,6 +101,7 @@ if __name__ == '__main__':
 
     move_argparse(
         rename_func,
+        rename_func_factory=rename_func_factory,
         func_arg_adders=[add_find,add_replace],
         func_arg_controller=controller,
         add_act_noext_only=True,
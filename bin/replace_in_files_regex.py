@@ -3,16 +3,13 @@
 import sys
 import argparse
 from argparse import RawTextHelpFormatter
+import itertools
+import logging
 import re
 import os.path
 
-from cirosantilli import files
-
-def _chomp(s):
-    if s and s[-1] == '\n':
-        return s[:-1]
-    else:
-        return s
+from cirosantilli import argparse_extras
+from cirosantilli import replace_in_files
 
 if __name__ == '__main__':
 
@@ -35,7 +32,11 @@ EXAMPLES
   #-D means *not* dry run. files are modified:
 
     find . -type f | %s -iD 'find(\d)' 'replace\1'
-""" % (f, f),
+
+  #-j: processes 8 files at a time. output is in the same order:
+
+    find . -type f | %s -j8 -D 'find(\d)' 'replace\1'
+""" % (f, f, f),
         formatter_class=RawTextHelpFormatter,
         )
 
@@ -78,6 +79,17 @@ EXAMPLES
         default=False,
         action="store_true",)
 
+    parser.add_argument('-a','--text',
+        help="also process binary files, which are skipped by default. "
+            "a file is binary if it has a null byte in its first bytes",
+        default=False,
+        action="store_true",)
+
+    parser.add_argument('-j','--workers',
+        help="number of processes that process files in parallel. default: 1",
+        default=1,
+        type=int,)
+
     parser.add_argument('find', 
         help="regex to find")
 
@@ -109,57 +121,27 @@ EXAMPLES
         path_separator = "\x00"
     else:
         path_separator = "\n"
-    paths = args.paths
-    if not sys.stdin.isatty(): #not connect to terminal teletype (tty): a pipe coming in!
-        paths_str = sys.stdin.read()
-        if paths_str:
-            stdin_paths = paths_str.split(path_separator) #splits at null
-            stdin_paths = filter(lambda p: p, stdin_paths) #removes empty paths (after last \n of \0)
-            paths.extend(stdin_paths)
+    #stdin paths are read while files are processed
+    paths = itertools.chain(
+        args.paths,
+        argparse_extras.iter_stdin_items(path_separator)
+    )
 
     find = args.find
     replace = args.replace
 
     #work!
-    sep = ' '*2
     p = re.compile(find, regex_params)
-    for path in paths:
-        new = ""
-        output = ""
-        had_change = False
-        try:
-
-            with open(path,'r') as f:
-
-                #multiline
-                if multiline_mode:
-                    old = f.read()
-                    #print replace
-                    old = _chomp(old)
-                    new = p.sub(replace, old)
-                    if old != new:
-                        had_change = True
-                        output = new + "\n\n"
-
-                #linewise
-                else:
-                    i = 0
-                    for old_line in f.xreadlines():
-                        old_line = _chomp(old_line)
-                        new_line = p.sub(replace, old_line)
-                        if old_line != new_line:
-                            output += "%i%s%s\n" % (i,sep,old_line)
-                            output += "%i%s%s\n" % (i,sep,new_line)
-                            had_change = True
-                        new += (new_line) + "\n"
-                        i=i+1
-
-        except IOError, e:
-            logging.error(e)
-            continue
-
-        if had_change:
-            output = "\n"+"="*70 + "\n" + path + "\n\n" + output
+    #reports are written by this process only, in the order of paths
+    for path, output, error in replace_in_files.replace_in_files(
+            paths,
+            p,
+            replace,
+            multiline=multiline_mode,
+            do_write=not_dry_run,
+            workers=args.workers,
+            skip_binary=not args.text):
+        if error is not None:
+            logging.error(error)
+        elif output:
             sys.stderr.write( output )
-            if not_dry_run:
-                files.write(path, new)
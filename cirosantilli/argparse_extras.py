@@ -11,6 +11,7 @@
 import os
 import sys
 import argparse
+import itertools
 import logging
 
 SECTION_TITLES = {
@@ -311,32 +312,109 @@ class StdinArgvPathsAction(argparse.Action):
     def __call__(self, parser, namespace, values, option_string=None):
         setattr(namespace, self.dest, CHAR_LOG_LEVELS[values[0]])
 
+STDIN_BUFSIZE = 2**16
+
+def iter_stdin_items(sep, encoding=None, bufsize=STDIN_BUFSIZE, stdin=None):
+    """
+    Yields the non empty items of stdin separated by sep,
+    as soon as each of them is read.
+
+    Reads at most bufsize bytes at a time, and only keeps the last incomplete
+    item in memory, so that callers can start working before the upstream
+    process has finished, and large inputs are never stored entirely.
+
+    :param sep: item separator. typically "\\n" or "\\0"
+    :param encoding: if given, each item is decoded with it
+    :param stdin: file to read from. default: sys.stdin.
+        nothing is read if it is a tty.
+
+    >>> import tempfile
+    >>> f = tempfile.TemporaryFile()
+    >>> f.write('a\\0\\0bc\\0d')
+    >>> f.seek(0)
+    >>> list(iter_stdin_items('\\0', 'utf-8', bufsize=2, stdin=f))
+    [u'a', u'bc', u'd']
+    """
+    if stdin is None:
+        stdin = sys.stdin
+    if stdin.isatty():
+        return
+    fd = stdin.fileno()
+    pending = ''
+    while True:
+        chunk = os.read(fd, bufsize)
+        if not chunk:
+            break
+        items = (pending + chunk).split(sep)
+        pending = items.pop()
+        for item in items:
+            if item:
+                if encoding:
+                    item = item.decode(encoding)
+                yield item
+    if pending:
+        if encoding:
+            pending = pending.decode(encoding)
+        yield pending
+
 def get_stdin_items(sep, encoding):
-    if not sys.stdin.isatty():
-        items_str = sys.stdin.read()
-        if items_str:
-            stdin_items = items_str.split(sep)
-            stdin_items = filter(lambda p: p, stdin_items) #only get non-empty items. last path is probably empty, since the items="path1\npath2\n" and split gives [path1, path2, ""]
-            return stdin_items
-    else:
-        return []
+    """
+    Returns a list of the non empty items of stdin separated by sep, not decoded.
+
+    To process items while they are read, use iter_stdin_items.
+    """
+    return list(iter_stdin_items(sep))
+
+NULL_RECORD_FIELD_SEPARATOR = '\t'
+
+def null_record(*fields):
+    """
+    Formats the null output format shared by scripts: fields separated by tabs,
+    terminated by a null byte.
+
+    It is meant for machines: paths cannot contain null bytes, so if only the last field
+    can contain tabs, which should therefore be the path, records can always be split back
+    with iter_stdin_items('\\0') and split_null_record.
+
+    >>> null_record('ff', 2, u'a\\tb') == u'ff\\t2\\ta\\tb\\0'
+    True
+    """
+    return NULL_RECORD_FIELD_SEPARATOR.join( '%s' % field for field in fields ) + '\0'
+
+def split_null_record(record, nfields):
+    """
+    Splits a record of null_record without its null byte into its nfields fields.
+
+    >>> split_null_record('ff\\t2\\ta\\tb', 3)
+    ['ff', '2', 'a\\tb']
+    """
+    return record.split(NULL_RECORD_FIELD_SEPARATOR, nfields - 1)
 
 def get_paths_from_stdin_and_argv(
             args,
             null_separated_input_argname='null_separated_input',
             paths_input_argname='null_separated_input',
             encoding='utf-8',
+            stream=False,
         ):
+    """
+    Returns the paths given on the command line followed by those given on stdin, decoded.
+
+    :param stream: if True, returns an iterator that reads stdin as it is consumed,
+        see iter_stdin_items. Else, returns a list.
+    """
 
     if getattr(args,'null_separated_input'):
         sep = "\0"
     else:
         sep = "\n"
 
-    paths = getattr(args,'paths')
-    paths.extend(get_stdin_items(sep,encoding))
-
-    return map(lambda s: s.decode(encoding), paths)
+    argv_paths = [ path.decode(encoding) for path in getattr(args,'paths') ]
+    stdin_paths = iter_stdin_items(sep, encoding)
+    if stream:
+        return itertools.chain(argv_paths, stdin_paths)
+    argv_paths.extend(stdin_paths)
+    return argv_paths
 
 def add_paths(
             parser,
@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+
+"""
+Finds files with identical contents, reading as little as possible.
+
+Files are narrowed down in three stages, each only looking at the files that
+still collide after the previous one:
+
+- size: from the stat, which the walk usually already has. no file is opened.
+- partial hash: hash of the first partial_size bytes.
+- full hash: hash of the entire file.
+
+Most files of a tree have a unique size, and most of those which do not
+already differ in their first bytes, so only true duplicates are read entirely.
+
+Paths which are hardlinks to a same inode are the same file, not duplicates:
+only the first path found for each inode is considered.
+"""
+
+import collections
+import itertools
+import os
+import stat
+import sys
+
+import argparse_extras
+import hashing
+
+PARTIAL_SIZE = 4*hashing.KBYTE
+
+OUTPUT_FORMATS = ('text', 'null')
+
+class DuplicateGroup(collections.namedtuple('DuplicateGroup', 'size digest paths')):
+    """
+    Files with the same contents.
+
+    :ivar size: size in bytes of each file
+    :ivar digest: full hash of each file
+    :ivar paths: one path per inode, in the order they were given
+    """
+    __slots__ = ()
+
+def _path_and_lstat(item):
+    """item is either a path or a files.FindEntry, whose stat may be cached by the walk"""
+    if isinstance(item, basestring):
+        return item, os.lstat(item)
+    return item.path, item.stat(follow_symlinks=False)
+
+def _write_error(path, error):
+    sys.stderr.write("%s: %s\n" % (path, error))
+
+def _split_by_hash(candidates, hasher, workers, on_error):
+    """
+    :param candidates: list of lists of paths that may be equal
+    :returns: list of (digest, paths) for the digests shared by more than one path
+    """
+    paths = ( path for group in candidates for path in group )
+    groups = collections.OrderedDict()
+    for path, digest, error in hashing.hash_paths(paths, hasher, workers=workers):
+        if error is not None:
+            on_error(path, error)
+            continue
+        groups.setdefault(digest, []).append(path)
+    return [ (digest, group) for digest, group in groups.iteritems() if len(group) > 1 ]
+
+def find_duplicates(paths, algorithm='sha1', partial_size=PARTIAL_SIZE,
+        min_size=1, workers=1, cache=None, on_error=_write_error):
+    """
+    Yields a DuplicateGroup for each set of files with equal contents.
+
+    Groups are yielded by decreasing size, since bigger duplicates are usually
+    those of interest.
+
+    Only regular files are considered: symlinks and other types are ignored.
+
+    :param paths: paths or files.FindEntry, such as those of files.find_entries.
+    :param partial_size: number of bytes of the partial hash.
+        files not larger than that are fully hashed by the partial hash,
+        and are not read again.
+    :param min_size: smaller files are ignored. the default ignores empty files,
+        which are all equal.
+    :param workers: number of files hashed in parallel. see hashing.hash_paths.
+    :param cache: a hashing.HashCache used for both the partial and the full hashes
+    :param on_error: function(path, exception) called for paths that cannot
+        be stat-ed or read, which are then ignored. default: write to stderr.
+
+    >>> import tempfile, shutil
+    >>> d = tempfile.mkdtemp()
+    >>> def mk(name, data):
+    ...     path = os.path.join(d, name)
+    ...     open(path, 'w').write(data)
+    ...     return path
+    >>> a, b, c = mk('a', 'ab' * 10), mk('b', 'ab' * 10), mk('c', 'ab' * 9 + 'ac')
+    >>> x, y = mk('x', 'x'), mk('y', 'x')
+    >>> os.link(a, os.path.join(d, 'a2'))
+    >>> groups = list(find_duplicates(sorted(os.path.join(d, n) for n in os.listdir(d)), partial_size=2))
+    >>> [ (group.size, map(os.path.basename, group.paths)) for group in groups ]
+    [(20, ['a', 'b']), (1, ['x', 'y'])]
+    >>> groups[0].digest == hashing.hash_file(a)
+    True
+    >>> shutil.rmtree(d)
+    """
+
+    #size stage
+    by_size = {}
+    inodes = set()
+    for item in paths:
+        try:
+            path, st = _path_and_lstat(item)
+        except OSError, e:
+            on_error(getattr(item, 'path', item), e)
+            continue
+        if not stat.S_ISREG(st.st_mode) or st.st_size < min_size:
+            continue
+        inode = (st.st_dev, st.st_ino)
+        if inode in inodes:
+            continue
+        inodes.add(inode)
+        by_size.setdefault(st.st_size, []).append(path)
+    del inodes
+    sizes = sorted(( size for size, group in by_size.iteritems() if len(group) > 1 ),
+            reverse=True)
+
+    def hasher(max_bytes):
+        result = hashing.file_hasher(algorithm, max_bytes)
+        if cache is not None:
+            result = cache.cached_hasher(result, hashing.hash_params(algorithm, max_bytes))
+        return result
+    partial_hasher = hasher(partial_size)
+    full_hasher = hasher(None)
+
+    #files are hashed one size at a time, so that groups are output as soon as found
+    #and only the paths of one size are in the hash pipeline at a time
+    for size in sizes:
+        candidates = [ by_size.pop(size) ]
+        if size > partial_size:
+            candidates = [ group for digest, group in
+                    _split_by_hash(candidates, partial_hasher, workers, on_error) ]
+            split = _split_by_hash(candidates, full_hasher, workers, on_error)
+        else:
+            split = _split_by_hash(candidates, partial_hasher, workers, on_error)
+        for digest, group in split:
+            yield DuplicateGroup(size, digest, group)
+
+def format_group(output_format, group):
+    """
+    Formats one DuplicateGroup.
+
+    Formats:
+
+    - text: one path per line, groups separated by an empty line, like fdupes.
+    - null: one record per path of size, digest and path, see argparse_extras.null_record,
+        then an extra null byte at the end of the group.
+
+    >>> format_group('null', DuplicateGroup(1, 'ff', ['a', 'b'])) == '1\\tff\\ta\\0001\\tff\\tb\\0\\0'
+    True
+    """
+    if output_format == 'text':
+        return ''.join( path + '\n' for path in group.paths ) + '\n'
+    if output_format == 'null':
+        return ''.join( argparse_extras.null_record(group.size, group.digest, path)
+                for path in group.paths ) + '\0'
+    raise ValueError("unknown output format: %s" % output_format)
+
+def parse_null_records(records):
+    """
+    Yields the DuplicateGroup of records in the null format of format_group,
+    such as the null separated items of the output of find_duplicates.py.
+
+    >>> list(parse_null_records(['1\\tff\\ta', '1\\tff\\tb', '2\\tee\\tc\\td', '2\\tee\\te']))
+    [DuplicateGroup(size=1, digest='ff', paths=['a', 'b']), DuplicateGroup(size=2, digest='ee', paths=['c\\td', 'e'])]
+    """
+    split = ( argparse_extras.split_null_record(record, 3) for record in records if record )
+    for (size, digest), group in itertools.groupby(split, lambda fields: tuple(fields[:2])):
+        yield DuplicateGroup(int(size), digest, [ fields[2] for fields in group ])
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
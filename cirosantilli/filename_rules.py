@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+
+"""
+Checks of basenames against naming rules, used by find_bad_filenames.py.
+
+A rule is either:
+
+- a RegexRule: all of them are combined into a single regex,
+    so each basename is scanned once for all of them.
+- a FunctionRule: an arbitrary test of the basename, for what regexes cannot do well,
+    such as length limits.
+
+New rules can be given to BasenameChecker, or added to DEFAULT_RULES.
+
+Problems are (rule name, detail) pairs, so that the output can be parsed.
+
+audit_tree also checks what cannot be seen from a single basename
+and breaks syncs to other operating systems: siblings that collide when case is ignored,
+as on Windows and macOS by default, or under unicode normalization, as on macOS,
+and paths that are too long for Windows.
+"""
+
+import os
+import re
+import unicodedata
+
+import argparse_extras
+import files
+from files import FORBIDDEN_BASENAME_CHARS, MAX_BNAME_LENGTH
+
+WINDOWS_RESERVED_NAMES = frozenset(
+        ['CON', 'PRN', 'AUX', 'NUL'] +
+        [ 'COM%d' % i for i in xrange(1, 10) ] +
+        [ 'LPT%d' % i for i in xrange(1, 10) ])
+WINDOWS_MAX_PATH = 260
+
+OUTPUT_FORMATS = ('text', 'null')
+
+class RegexRule(object):
+    """
+    Rule broken by each match of a regex in the basename.
+
+    :param name: identifier of the rule. must be a valid python identifier.
+    :param pattern: regex. it must not contain groups.
+    :param detail: function : match --> string that explains the problem
+    """
+
+    def __init__(self, name, pattern, detail):
+        self.name = name
+        self.pattern = pattern
+        self.detail = detail
+
+class FunctionRule(object):
+    """
+    Rule broken when a function of the basename returns a detail string instead of None.
+
+    :param name: identifier of the rule
+    :param func: function : basename --> string that explains the problem, or None
+    """
+
+    def __init__(self, name, func):
+        self.name = name
+        self.func = func
+
+def _too_long(bname):
+    if len(bname) > MAX_BNAME_LENGTH:
+        return "basename longer than %d" % MAX_BNAME_LENGTH
+    return None
+
+def _noext_trailing_dot(bname):
+    if os.path.splitext(bname)[0].endswith('.'):
+        return "basename without extension ends in a dot '.'"
+    return None
+
+def _windows_reserved(bname):
+    if bname.split('.', 1)[0].rstrip(' ').upper() in WINDOWS_RESERVED_NAMES:
+        return "basename is reserved on windows"
+    return None
+
+DEFAULT_RULES = [
+    RegexRule(
+        'forbidden_char',
+        u"[%s]" % re.escape(FORBIDDEN_BASENAME_CHARS),
+        lambda match: u"forbidden char: '%s' decimal: %d" % (match.group(), ord(match.group())),
+    ),
+    FunctionRule('too_long', _too_long),
+    RegexRule(
+        'leading_hyphen',
+        u"^-",
+        lambda match: u"basename starts with a hyphen '-'",
+    ),
+    FunctionRule('noext_trailing_dot', _noext_trailing_dot),
+]
+
+#rules of windows, which are only of interest for files that go there
+PORTABILITY_RULES = [
+    RegexRule(
+        'windows_forbidden_char',
+        u"\\?",
+        lambda match: u"char forbidden on windows: '%s'" % match.group(),
+    ),
+    RegexRule(
+        'windows_trailing',
+        u"[ .]\\Z",
+        lambda match: u"basename ends in '%s', which windows removes" % match.group(),
+    ),
+    FunctionRule('windows_reserved', _windows_reserved),
+]
+
+class BasenameChecker(object):
+    """
+    Checks basenames against a list of rules.
+
+    The regexes of all RegexRule are combined into one alternation with one named group
+    per rule, so each basename is scanned once, whatever the number of rules.
+    Where several regexes match at a same position, only the first rule is reported.
+
+    Problems are given in the order of the rules, and each distinct problem only once,
+    in the order of its first match for regex rules.
+
+    >>> checker = BasenameChecker()
+    >>> checker.problems(u'-a|b|c..')
+    [('forbidden_char', u"forbidden char: '|' decimal: 124"), ('leading_hyphen', u"basename starts with a hyphen '-'"), ('noext_trailing_dot', "basename without extension ends in a dot '.'")]
+    >>> checker.problems(u'ok.txt')
+    []
+    >>> BasenameChecker([ rule for rule in DEFAULT_RULES if rule.name == 'too_long' ]).problems(u'a' * 256)
+    [('too_long', 'basename longer than 255')]
+    """
+
+    def __init__(self, rules=None):
+        if rules is None:
+            rules = DEFAULT_RULES
+        self.rules = list(rules)
+        regex_rules = [ rule for rule in self.rules if isinstance(rule, RegexRule) ]
+        self.regex_rules = dict( (rule.name, rule) for rule in regex_rules )
+        if regex_rules:
+            self.regex = re.compile(
+                u'|'.join( u'(?P<%s>%s)' % (rule.name, rule.pattern) for rule in regex_rules ),
+                re.UNICODE)
+        else:
+            self.regex = None
+
+    def problems(self, bname):
+        """
+        :returns: list of (rule name, detail) of the rules that bname breaks.
+            empty if it breaks none.
+        """
+        matched = {}
+        if self.regex is not None:
+            for match in self.regex.finditer(bname):
+                details = matched.setdefault(match.lastgroup, [])
+                detail = self.regex_rules[match.lastgroup].detail(match)
+                if detail not in details:
+                    details.append(detail)
+        problems = []
+        for rule in self.rules:
+            if isinstance(rule, RegexRule):
+                problems.extend( (rule.name, detail) for detail in matched.get(rule.name, ()) )
+            else:
+                detail = rule.func(bname)
+                if detail is not None:
+                    problems.append( (rule.name, detail) )
+        return problems
+
+def collision_key(name):
+    """
+    Returns the key under which name and the names it collides with are the same,
+    on case insensitive or unicode normalizing filesystems.
+    """
+    if isinstance(name, unicode):
+        return unicodedata.normalize('NFC', name).lower()
+    return name.lower()
+
+def find_collisions(names):
+    """
+    Finds names that are different but would be the same file on
+    case insensitive or unicode normalizing filesystems.
+
+    Uses a dictionary from normalized lowercase names, so the cost is linear in the number of names.
+
+    :param names: basenames of the children of a directory
+    :returns: list of (rule name, name, name it collides with), where rule name is
+        'case_collision' if the names only differ in case, or
+        'normalization_collision' if they have the same NFC normalization.
+
+    >>> find_collisions([u'a', u'B', u'b', u'\\xe9', u'e\\u0301', u'A'])
+    [('case_collision', u'b', u'B'), ('normalization_collision', u'e\\u0301', u'\\xe9'), ('case_collision', u'A', u'a')]
+    """
+    seen = {}
+    collisions = []
+    for name in names:
+        key = collision_key(name)
+        other = seen.get(key)
+        if other is None:
+            seen[key] = name
+        else:
+            if isinstance(name, unicode) and unicodedata.normalize('NFC', name) \
+                    == unicodedata.normalize('NFC', other):
+                rule_name = 'normalization_collision'
+            else:
+                rule_name = 'case_collision'
+            collisions.append( (rule_name, name, other) )
+    return collisions
+
+def audit_tree(root, checker=None, max_path_length=WINDOWS_MAX_PATH):
+    """
+    Yields (path, rule name, detail) for all portability problems of the paths under root.
+
+    Each directory is listed once, and its children are checked for collisions
+    with find_collisions while they are in memory, so memory usage is that of the largest directory.
+
+    Symlinks are not followed.
+
+    :param checker: BasenameChecker for each basename.
+        default: one with DEFAULT_RULES and PORTABILITY_RULES.
+    :param max_path_length: paths relative to root with at least this many characters are reported.
+        default: windows MAX_PATH. lower it by the length of the path where the tree will be synced to.
+
+    >>> import tempfile
+    >>> d = tempfile.mkdtemp()
+    >>> for name in ('a', 'A', 'con.txt'): open(os.path.join(d, name), 'w').close()
+    >>> sorted( (os.path.basename(path), rule, detail) for (path, rule, detail) in audit_tree(d) )
+    [('a', 'case_collision', u'differs only in case from sibling: A'), ('con.txt', 'windows_reserved', 'basename is reserved on windows')]
+    >>> files.remove_recursive(d)
+    """
+    if checker is None:
+        checker = BasenameChecker(DEFAULT_RULES + PORTABILITY_RULES)
+    dirs = [root]
+    while dirs:
+        directory = dirs.pop()
+        try:
+            entries = files.list_entries(directory)
+        except OSError, e:
+            yield directory, 'unreadable', str(e)
+            continue
+        entries.sort(key=lambda entry: entry.name)
+        for entry in entries:
+            for rule_name, detail in checker.problems(entry.name):
+                yield entry.path, rule_name, detail
+            if len(os.path.relpath(entry.path, root)) >= max_path_length:
+                yield entry.path, 'path_too_long', "path has %d characters or more" % max_path_length
+            if entry.is_dir(follow_symlinks=False):
+                dirs.append(entry.path)
+        for rule_name, name, other in find_collisions([ entry.name for entry in entries ]):
+            if rule_name == 'case_collision':
+                detail = u"differs only in case from sibling: %s" % other
+            else:
+                detail = u"same unicode NFC normalization as sibling: %s" % other
+            yield os.path.join(directory, name), rule_name, detail
+
+def format_problem(output_format, path, rule_name, detail):
+    """
+    Formats one problem found.
+
+    Formats:
+
+    - text: path, then detail, each followed by a newline, then an empty line.
+    - null: rule name, detail and path, see argparse_extras.null_record.
+
+    >>> format_problem('null', u'a', 'too_long', u'long') == u'too_long\\tlong\\ta\\0'
+    True
+    """
+    if output_format == 'text':
+        return u'%s\n%s\n\n' % (path, detail)
+    if output_format == 'null':
+        return argparse_extras.null_record(rule_name, detail, path)
+    raise ValueError("unknown output format: %s" % output_format)
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
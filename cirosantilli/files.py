@@ -1,13 +1,28 @@
 #!/usr/bin/env python
 import ctypes
+import errno
+import fnmatch
+import itertools
 import logging
 import os
+import Queue
 import re
 import shutil
+import sqlite3
 import stat
 import sys
+import tempfile
+import threading
 
-from utils import CONTROL_CHARS_STR
+try:
+    from os import scandir as _scandir
+except ImportError:
+    try:
+        from scandir import scandir as _scandir
+    except ImportError:
+        _scandir = None
+
+from utils import CONTROL_CHARS_STR, ResubPipeline
 
 #FORBIDDEN_PRINTABLE_BASENAME_CHARS_STR = '|\\?*<":>+[]/'
 MAX_BNAME_LENGTH = 255
@@ -96,7 +111,8 @@ def move(paths, rename_func, do_move=False, **kwargs):
 
     :param paths: paths to act on
 
-        not an iterator, so that sorting can be done.
+        may be an iterator, such as argparse_extras.iter_stdin_items, only if sort_func
+        is None. in that case, new names are calculated while paths are being produced.
 
         relative paths are converted to full paths before rename_func acts on them
 
@@ -105,7 +121,7 @@ def move(paths, rename_func, do_move=False, **kwargs):
         to do a function that uses only basename information, use the act_basename_only
         decorator
 
-    :type paths: list of strigs
+    :type paths: list of strigs, or iterable of strings if sort_func is None
     :param rename_func: rename function of that returns the *full path* from a given *full path*
     :type rename_func: function with signature (string,*args,**kwargs)
     :param do_move: if True, really renames, else, only outputs changes that would be done
@@ -194,6 +210,10 @@ def move(paths, rename_func, do_move=False, **kwargs):
 
         function used to sort paths, and therefore decide order in which paths are renamed
 
+        if None, paths are not sorted, and are used in the given order.
+        in that case, children must be given before their parent dirs,
+        as is done by `find -depth`.
+
         clearly, this function can have an impact on the rename results.
 
         example:
@@ -217,6 +237,26 @@ def move(paths, rename_func, do_move=False, **kwargs):
 
     :type sort_func: function([string, ...])
 
+    :param journal: default: None
+
+        if given, path of an append only journal where the rename plan
+        and its progress are written, so that if the process is killed
+        the batch can be resumed or rolled back with move_plan.resume_move
+        and move_plan.rollback_move.
+
+    :type journal: string
+
+    :param manifest: default: None
+
+        if given and do_move, path of a manifest of the inode, old path and new path
+        of the renames done, which can be undone with move_plan.undo_move.
+
+    :type manifest: string
+
+    All the renames are planned before any is done, see move_plan.MovePlan.
+    Chains and cycles of renames, such as a -> b, b -> a, are done in an order
+    that works, using temporary names if needed.
+
     TODO
     ====
 
@@ -228,6 +268,8 @@ def move(paths, rename_func, do_move=False, **kwargs):
 
     """
 
+    from move_plan import MovePlan
+
     sort_func = kwargs.pop("sort_func", sorted)
     func_args = kwargs.pop("func_args", [])
     func_kwargs = kwargs.pop("func_kwargs", {})
@@ -235,11 +277,15 @@ def move(paths, rename_func, do_move=False, **kwargs):
     can_change_dirs = kwargs.pop("can_change_dirs", True) or make_missing_dirs
     mv_func = kwargs.pop("mv_func", os.rename)
     overwrite = kwargs.pop("overwrite", False)
+    journal = kwargs.pop("journal", None)
+    manifest = kwargs.pop("manifest", None)
 
-    paths = map(os.path.abspath,paths)
-    paths = sort_func(paths,reverse=True)
-    warnings = []
-    errors = []
+    if sort_func is None:
+        paths = itertools.imap(os.path.abspath,paths)
+    else:
+        paths = map(os.path.abspath,paths)
+        paths = sort_func(paths,reverse=True)
+    moves = []
     for path in paths:
 
         head, bname = os.path.split(path)
@@ -250,80 +296,18 @@ def move(paths, rename_func, do_move=False, **kwargs):
 
             logging.info( "%s\n%s\n" % (path,new_path) )
 
-            #make sure new path is clear
-            if os.path.exists(new_path):
-                if overwrite and do_move:
-                    try:
-                        remove_recursive(new_path)
-                    except Exception,e:
-                        errors.append(
-                            "os error: could not remove existing path"
-                            "\n%s\n%s\n\n%s" % (path,new_path,e) 
-                        )
-                        continue
-                else:
-                    warnings.append(
-                            "new path already exists."
-                            "rename skipped\nold path:"
-                            "%s\nnew path:  %s" % (path, new_path) 
-                    )
-                    continue
+            #TODO moving to another dir is not implemented yet.
+            #see can_change_dirs and make_missing_dirs
+            if os.path.split(new_path)[0] != head:
+                continue
 
-            #make sure new dir exists
-            old_dir = os.path.split(path)[0]
-            new_dir = os.path.split(new_path)[0]
-            if old_dir != new_dir:
-                makedirs = False
-                continue #TODO this is for security before I get the tests done!!!!!!
-                if can_change_dirs:
-                    if os.path.exists(new_dir):
-                        if not os.path.isdir(new_dir): #its a file
-                            if make_missing_dirs:
-                                makedirs = True
-                                if not os.path.commonprefix([old_path, new_dir]) == old_path: #old_path is an ancestor for new path
-                                    if overwrite:
-                                        try:
-                                            shutil.rmtree(new_path)
-                                        except Exception,e:
-                                            print e, "TODO"
-                                            continue
-                                    else:
-                                        print overwrite_error #TODO
-                                elif overwrite: #new_dir == old_path: must move old path to temp path!
-                                    #TODO get temppath
-                                    try:
-                                        os.move(path,tmppath)
-                                    except Exception,e:
-                                        errors.append( "TODO" % (path,new_path,e) )
-                                        continue
-                                    path = temppath
-                            else:
-                                print 'missing dirs warn TODO'
-                    elif make_missing_dirs:
-                        makedirs = True
-                    else:
-                        print 'missing dirs warn TODO'
-
-                    #now that the area is clear, make the missing dirs if needed
-                    if makedirs and do_move:
-                        try:
-                            os.makedirs(new_dir) #ensure dir exists
-                        except Exception,e:
-                            errors.append( "os error: could not create non-existant dirs for new path. \n%s\n%s\n\n%s" % (path,new_path,e) )
-                            continue
-                    else:
-                        warnings.append("new dir does not exist\n%s\n%s\n" % (path, new_path) )
-                        continue
-                else:
-                    warnings.append("new path is in a different directory from old one. rename skipped\nold path:  %s\nnew path:  %s" % (path, new_path) )
-                    continue
+            moves.append( (path, new_path) )
 
-            #move
-            if do_move:
-                try:
-                    mv_func(path, new_path)
-                except Exception,e:
-                    errors.append( "os error: could not rename \n%s\n%s\n\n%s" % (path,new_path,e) )
+    plan = MovePlan(moves, overwrite=overwrite and do_move)
+    warnings = plan.warnings
+    errors = []
+    if do_move:
+        errors = plan.apply(mv_func, journal_path=journal, manifest_path=manifest)
 
     if warnings:
         logging.warning("WARNINGS")
@@ -354,8 +338,9 @@ def find(root='./', **kwargs):
 
     2)  paths_list = [ p for p in find('.') ] 
 
-    This basically adds a more convenient interface to find_rec by setting default values
-    for kwargs, and the initial depth.
+    This is a thin path only layer over find_entries. If you need to know
+    the type of the found paths, use find_entries instead, since it avoids
+    one stat per path.
 
     @root: root under which recurstion will be done.
 
@@ -375,6 +360,92 @@ def find(root='./', **kwargs):
         takes a directory path, and returns True iff the search
         should recurse under that directory.
 
+    @ordered: boolean.
+        default: False
+        if True, the children of each directory are output sorted by name,
+        so that the output is deterministic.
+        files are output in the same order as the sorted list of their paths,
+        e.g. ./a.txt before ./a/b, and each directory just before its contents.
+        else, they are output in the order given by the OS,
+        or in the order in which they were listed if workers > 1.
+
+    @workers: integer.
+        default: 1
+        number of threads used to list directories.
+        if greater than 1, several subtrees are listed concurrently,
+        which is much faster on high latency filesystems such as NFS.
+        descend_func is always called from the calling thread.
+
+    @queue_size: integer.
+        default: 4 * workers
+        maximum number of directories being listed, or whose listings were
+        not yet consumed, at any given time if workers > 1.
+
+    @index: TreeIndex.
+        default: None
+        if given, directory contents are taken from this index instead
+        of listing directories. the walk is then done on a single thread.
+        for directories under root which are not in the index,
+        falls back to listing them.
+
+    @follow_links: boolean.
+        default: True
+        if True, descends into symlinks to directories, except those
+        that point to one of their own ancestors, which would recurse forever.
+
+    @same_filesystem: boolean.
+        default: False
+        if True, does not descend into directories on another filesystem than root,
+        like find -xdev. costs one stat per directory.
+
+    @unique_dirs: boolean.
+        default: False
+        if True, remembers the (st_dev, st_ino) of every directory descended into,
+        and descends into each of them only once, even if it is reachable
+        through several symlinks or bind mounts.
+        costs one stat per directory, and memory per directory.
+
+    @type: 'f', 'd' or None.
+        default: None
+        if 'f', only outputs regular files, if 'd' only directories,
+        if None outputs all types.
+        symlinks are considered to be of the type they point to iff follow_links.
+
+    @exts: iterable of strings.
+        default: None
+        if given, only outputs paths whose extension, without the dot,
+        is in exts. comparison is case insensitive.
+
+    @include: list of strings or compiled regexes.
+        default: None
+        if given, only outputs paths whose basename matches one of the patterns.
+        strings are globs that must match the entire basename, such as '*.mp3'.
+        regexes need only match somewhere in the basename.
+
+    @exclude: list of strings or compiled regexes.
+        default: None
+        same syntax as include.
+        paths whose basename match are not output, and if they are directories
+        they are not descended into.
+
+    All filters are checked on basenames before anything that may require a stat.
+
+    """
+
+    for entry in find_entries(root, **kwargs):
+        yield entry.path
+
+def find_entries(root='./', **kwargs):
+    """
+    Same as find, but yields FindEntry objects instead of paths.
+
+    Examples:
+
+        for entry in files.find_entries('.', max_depth=2):
+            if entry.is_file():
+                print entry.depth, entry.path
+
+    Takes the same kwargs as find.
     """
 
     #standard values for the kwargs
@@ -383,18 +454,53 @@ def find(root='./', **kwargs):
                     ['min_depth',0],
                     ['max_depth',float("inf")],
                     ['descend_func',lambda p: True],
+                    ['ordered',False],
+                    ['workers',1],
+                    ['follow_links',True],
+                    ['same_filesystem',False],
+                    ['unique_dirs',False],
+                    ['type',None],
+                    ['exts',None],
+                    ['include',None],
+                    ['exclude',None],
                 ]
                 + kwargs.items()
             )
 
-    for path in find_rec(root,1,**kwargs):
-        yield path
+    kwargs['_accept'] = _make_accept(kwargs)
+    kwargs['_exclude'] = _make_name_matcher(kwargs['exclude'])
+
+    if kwargs['same_filesystem'] or kwargs['unique_dirs']:
+        try:
+            root_stat = os.stat(root)
+        except OSError, exc:
+            sys.stderr.write(str(exc) + "\n")
+            return
+        kwargs['_root_dev'] = root_stat.st_dev
+        if kwargs['unique_dirs']:
+            kwargs['_visited'] = set([ (root_stat.st_dev, root_stat.st_ino) ])
+
+    index = kwargs.pop('index', None)
+    if index is not None:
+        kwargs['list_func'] = index.list_entries
+        entries = find_entries_rec(root,1,**kwargs)
+    elif kwargs['workers'] > 1:
+        kwargs.setdefault('queue_size', 4 * kwargs['workers'])
+        if kwargs['ordered']:
+            entries = _find_entries_parallel_ordered(root, **kwargs)
+        else:
+            entries = _find_entries_parallel(root, **kwargs)
+    else:
+        entries = find_entries_rec(root,1,**kwargs)
+
+    for entry in entries:
+        yield entry
 
-def find_rec(root, curdepth, **kwargs ):
+def find_entries_rec(root, curdepth, **kwargs):
     """
     Recursive depth first finding of files.
 
-    For a convenient minimalist interface for this function, use find()
+    For a convenient minimalist interface for this function, use find_entries()
 
     The main design goal of this function is efficiency rather
     than interface convenience. As such:
@@ -405,7 +511,11 @@ def find_rec(root, curdepth, **kwargs ):
         or by using values which are easily avalilable in the function
         but would be more expensive to calculate outside it (current depth
         which would require counting '/' or '\' in the path otherwise )
-        
+
+    * directories are listed only once with scandir when available,
+        and the entry type given by the kernel is reused, so that
+        no stat is done per entry on most filesystems.
+
     * a generator expression is used to return values instead of a list.
 
         this means that vere little memory is used to loop over the search
@@ -414,44 +524,875 @@ def find_rec(root, curdepth, **kwargs ):
     """
 
     try:
-        os.listdir(root)
-    except Exception, exc:
-        sys.stderr.write(exc)
-        yield
+        entries = kwargs.get('list_func', list_entries)(root, curdepth)
+    except OSError, exc:
+        sys.stderr.write(str(exc) + "\n")
+        return
 
-    descend_func = kwargs['descend_func']
+    exclude = kwargs.get('_exclude')
+    if exclude is not None:
+        entries = [ entry for entry in entries if not exclude(entry.name) ]
 
-    for relpath in os.listdir(root):
+    if kwargs.get('ordered'):
+        _sort_entries(entries, kwargs)
 
-        path = os.path.join(root, relpath)
+    min_depth = kwargs['min_depth']
+    accept = kwargs.get('_accept')
 
-        if ( ( curdepth >= kwargs['min_depth'] ) ):
-            yield path
+    for entry in entries:
+
+        if curdepth >= min_depth and ( accept is None or accept(entry) ):
+            yield entry
+
+        if _descend(entry, curdepth, kwargs):
+
+            for entry in find_entries_rec(entry.path,curdepth+1,**kwargs):
+                yield entry
+
+def _make_name_matcher(patterns):
+    """
+    Compiles a list of basename patterns into a single function : str --> boolean
+    which is True iff the basename matches any of the patterns.
+
+    Strings are shell globs as understood by fnmatch, case sensitive,
+    and must match the entire basename.
+    Compiled regexes only need to match somewhere in the basename.
+
+    :returns: None if patterns is empty
+
+    >>> m = _make_name_matcher(['*.txt', re.compile('^a')])
+    >>> m('b.txt'), m('ab'), m('b.md')
+    (True, True, False)
+    """
+    if not patterns:
+        return None
+    globs = [ p for p in patterns if isinstance(p, basestring) ]
+    searches = [ p.search for p in patterns if not isinstance(p, basestring) ]
+    if globs:
+        searches.append(re.compile(
+                '|'.join( '(?:%s)' % fnmatch.translate(g) for g in globs ),
+                re.UNICODE).match)
+    if len(searches) == 1:
+        return searches[0]
+    def matcher(name):
+        for search in searches:
+            if search(name):
+                return True
+        return False
+    return matcher
+
+def _make_accept(kwargs):
+    """
+    Makes the function : FindEntry --> boolean that decides if find_entries
+    outputs an entry, from the type, exts and include kwargs.
+
+    Basename checks are done before the type check, since the type
+    may require a stat.
+
+    :returns: None if no filter is given
+    """
+
+    type_ = kwargs['type']
+    exts = kwargs['exts']
+    include = _make_name_matcher(kwargs['include'])
+    if type_ is None and exts is None and include is None:
+        return None
+    if exts is not None:
+        exts = frozenset( ext.lower() for ext in exts )
+    follow_links = kwargs['follow_links']
+
+    def accept(entry):
+        name = entry.name
+        if exts is not None and extension(name).lower() not in exts:
+            return False
+        if include is not None and not include(name):
+            return False
+        if type_ == 'f':
+            return entry.is_file(follow_symlinks=follow_links)
+        if type_ == 'd':
+            return entry.is_dir(follow_symlinks=follow_links)
+        return True
+
+    return accept
+
+def _descend(entry, curdepth, kwargs):
+    """
+    True iff the walk of find_entries should descend into entry.
+
+    Stats the directory only if same_filesystem or unique_dirs are given.
+
+    follow_links and same_filesystem default to the defaults of find_entries,
+    for callers of find_rec and find_entries_rec that do not give them.
+    """
+
+    if curdepth >= kwargs['max_depth']:
+        return False
+
+    follow_links = kwargs.get('follow_links', True)
+    if not entry.is_dir(follow_symlinks=follow_links):
+        return False
+    if follow_links and entry.is_symlink() and is_symlink_loop(entry.path):
+        return False
+
+    visited = kwargs.get('_visited')
+    same_filesystem = kwargs.get('same_filesystem', False)
+    if same_filesystem or visited is not None:
+        try:
+            st = entry.stat()
+        except OSError:
+            return False
+        if same_filesystem and st.st_dev != kwargs['_root_dev']:
+            return False
+        if visited is not None:
+            key = (st.st_dev, st.st_ino)
+            if key in visited:
+                return False
+            if not kwargs['descend_func'](entry.path):
+                return False
+            visited.add(key)
+            return True
+
+    return kwargs['descend_func'](entry.path)
+
+def is_symlink_loop(path):
+    """
+    True iff path resolves to the same directory as one of its ancestors,
+    so that recursing into it would never end.
+
+    Only does syscalls when path or one of its ancestors is a symlink,
+    since realpath stops there.
+
+    >>> import tempfile
+    >>> d = tempfile.mkdtemp()
+    >>> os.symlink(d, os.path.join(d, 'l'))
+    >>> is_symlink_loop(os.path.join(d, 'l'))
+    True
+    >>> is_symlink_loop(d)
+    False
+    >>> shutil.rmtree(d)
+    """
+    target = os.path.realpath(path)
+    head = os.path.dirname(os.path.abspath(path))
+    while True:
+        if os.path.realpath(head) == target:
+            return True
+        new_head = os.path.dirname(head)
+        if new_head == head:
+            return False
+        head = new_head
+
+def _sort_entries(entries, kwargs):
+    """
+    Sorts the children of a directory in the order of find_entries with ordered=True:
+    by name, but with a path separator after the names of directories,
+    so that files are output in the same order as the sorted list of all their paths.
+    """
+    follow_links = kwargs.get('follow_links', True)
+    def key(entry):
+        if entry.is_dir(follow_symlinks=follow_links):
+            return entry.name + os.sep
+        return entry.name
+    entries.sort(key=key)
+
+class _Listing(object):
+    """
+    A directory to be listed by a _ListingPool, and the result of the listing.
+    """
+
+    __slots__ = ('path', 'depth', 'entries', 'error', 'done')
+
+    def __init__(self, path, depth):
+        self.path = path
+        self.depth = depth
+        self.entries = None
+        self.error = None
+        self.done = threading.Event()
+
+    def result(self):
+        """
+        Waits for the listing to be done and returns its entries.
+
+        :raises: the exception of the listing if it failed, usually an OSError
+        """
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.entries
+
+class _ListingPool(object):
+    """
+    Daemon threads that run list_entries on submitted _Listing objects.
+
+    Listing is mostly waiting on IO, during which the GIL is released,
+    so threads are enough to keep several listings in flight.
+
+    :param workers: number of threads
+    :param queue_size: size of the bounded work queue.
+        callers must not have more than queue_size listings in flight
+    :param done_queue: if given, each finished listing is also put on it
+    :type done_queue: Queue.Queue
+    """
+
+    def __init__(self, workers, queue_size, done_queue=None):
+        self.tasks = Queue.Queue(queue_size)
+        self.done_queue = done_queue
+        self.threads = []
+        for i in xrange(workers):
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def _work(self):
+        while True:
+            listing = self.tasks.get()
+            if listing is None:
+                return
+            try:
+                listing.entries = list_entries(listing.path, listing.depth)
+            except Exception, exc:
+                #also other exceptions, which the consumer re-raises, so that it never waits forever
+                listing.error = exc
+            finally:
+                listing.done.set()
+                if self.done_queue is not None:
+                    self.done_queue.put(listing)
+
+    def submit(self, path, depth):
+        listing = _Listing(path, depth)
+        self.tasks.put(listing)
+        return listing
+
+    def close(self):
+        """
+        Makes the threads stop once the listings already submitted are done,
+        and waits for them.
+        """
+        for thread in self.threads:
+            self.tasks.put(None)
+        for thread in self.threads:
+            thread.join()
+
+def _find_entries_parallel(root, **kwargs):
+    """
+    Unordered parallel version of find_entries_rec.
+
+    Directories to list are kept on a stack, so that the walk stays
+    mostly depth first and the stack small.
+    Each directory is output as soon as any worker finishes listing it.
+    """
+
+    min_depth = kwargs['min_depth']
+    queue_size = kwargs['queue_size']
+    accept = kwargs.get('_accept')
+    exclude = kwargs.get('_exclude')
+
+    done_queue = Queue.Queue()
+    pool = _ListingPool(kwargs['workers'], queue_size, done_queue)
+    pending = [ (root, 1) ]
+    in_flight = 0
+    try:
+        while pending or in_flight:
+            while pending and in_flight < queue_size:
+                pool.submit(*pending.pop())
+                in_flight += 1
+            listing = done_queue.get()
+            in_flight -= 1
+
+            if listing.error is not None:
+                if not isinstance(listing.error, OSError):
+                    raise listing.error
+                sys.stderr.write(str(listing.error) + "\n")
+                continue
+
+            curdepth = listing.depth
+            for entry in listing.entries:
+
+                if exclude is not None and exclude(entry.name):
+                    continue
+
+                if curdepth >= min_depth and ( accept is None or accept(entry) ):
+                    yield entry
+
+                if _descend(entry, curdepth, kwargs):
+                    pending.append( (entry.path, curdepth+1) )
+    finally:
+        pool.close()
+
+def _find_entries_parallel_ordered(root, **kwargs):
+    """
+    Ordered parallel version of find_entries_rec.
+
+    Gives exactly the same output as find_entries_rec with ordered=True,
+    except that with unique_dirs, which one of the paths to a same directory
+    gets walked may differ, since all subdirectories of a directory are
+    chosen before descending into any of them.
+
+    As soon as a directory listing is consumed, its subdirectories are
+    submitted for listing, while up to queue_size listings are not consumed.
+    Subdirectories that were not submitted in advance are listed
+    when they are reached.
+    """
+
+    state = {
+        'pool': _ListingPool(kwargs['workers'], kwargs['queue_size']),
+        'unconsumed': 0,
+    }
+    try:
+        for entry in _find_entries_parallel_ordered_rec(
+                state['pool'].submit(root, 1), state, **kwargs):
+            yield entry
+    finally:
+        state['pool'].close()
+
+def _find_entries_parallel_ordered_rec(listing, state, **kwargs):
+
+    pool = state['pool']
+    try:
+        entries = listing.result()
+    except OSError, exc:
+        sys.stderr.write(str(exc) + "\n")
+        return
+    finally:
+        state['unconsumed'] -= 1
+
+    exclude = kwargs.get('_exclude')
+    if exclude is not None:
+        entries = [ entry for entry in entries if not exclude(entry.name) ]
+
+    _sort_entries(entries, kwargs)
+
+    curdepth = listing.depth
+    accept = kwargs.get('_accept')
+    min_depth = kwargs['min_depth']
+    queue_size = kwargs['queue_size']
+
+    #None: do not descend. False: descend, but not submitted yet.
+    children = []
+    for entry in entries:
+        if _descend(entry, curdepth, kwargs):
+            if state['unconsumed'] < queue_size:
+                children.append(pool.submit(entry.path, curdepth+1))
+                state['unconsumed'] += 1
+            else:
+                children.append(False)
+        else:
+            children.append(None)
+
+    for entry, child in itertools.izip(entries, children):
+
+        if curdepth >= min_depth and ( accept is None or accept(entry) ):
+            yield entry
+
+        if child is not None:
+            if child is False:
+                child = pool.submit(entry.path, curdepth+1)
+                state['unconsumed'] += 1
+            for entry in _find_entries_parallel_ordered_rec(child, state, **kwargs):
+                yield entry
+
+def find_rec(root, curdepth, **kwargs):
+    """
+    Path only version of find_entries_rec. Kept for backwards compatibility.
+
+    >>> import tempfile, shutil
+    >>> d = tempfile.mkdtemp()
+    >>> os.mkdir(os.path.join(d, 'a'))
+    >>> open(os.path.join(d, 'a', 'b'), 'w').close()
+    >>> sorted( os.path.relpath(path, d) for path in find_rec(d, 1, min_depth=0,
+    ...         max_depth=float('inf'), descend_func=lambda path: True) )
+    ['a', 'a/b']
+    >>> shutil.rmtree(d)
+    """
+    for entry in find_entries_rec(root, curdepth, **kwargs):
+        yield entry.path
+
+def list_entries(root, depth=1):
+    """
+    Returns a list of FindEntry for the direct children of root.
 
-        if ( os.path.isdir(path)
-            and descend_func(path)
-            and ( curdepth < kwargs['max_depth'] ) ):
+    Uses scandir if available (python 3.5+ os.scandir, or the scandir package),
+    else falls back to os.listdir, in which case the entry type is only
+    known after a stat.
 
-            for path in find_rec(path,curdepth+1,**kwargs):
-                yield path
+    The directory is read entirely before returning, so that no file
+    descriptor stays open during recursion.
+
+    :raises: OSError if root cannot be listed
+    """
+    if _scandir is None:
+        return [ FindEntry(os.path.join(root, name), name, depth)
+                for name in os.listdir(root) ]
+    return [ FindEntry(dirent.path, dirent.name, depth, dirent)
+            for dirent in _scandir(root) ]
+
+class FindEntry(object):
+    """
+    A path found by find_entries.
+
+    Light wrapper around a scandir DirEntry, which adds the find depth,
+    and which also works when scandir is not available.
+
+    Type and stat information are only calculated when first required,
+    and are cached afterwards.
+
+    :ivar path: path of the entry, root joined with name
+    :ivar name: basename of the entry
+    :ivar depth: depth at which the entry was found. 1 for children of root.
+
+    >>> e = FindEntry(os.curdir, os.curdir, 0)
+    >>> e.is_dir(), e.is_file(), e.is_symlink()
+    (True, False, False)
+    >>> e.stat() is e.stat()
+    True
+    """
+
+    __slots__ = ('path', 'name', 'depth', '_dirent', '_stat', '_lstat')
+
+    def __init__(self, path, name, depth, dirent=None):
+        self.path = path
+        self.name = name
+        self.depth = depth
+        self._dirent = dirent
+        self._stat = None
+        self._lstat = None
+
+    def __repr__(self):
+        return '<FindEntry %r depth=%d>' % (self.path, self.depth)
+
+    def stat(self, follow_symlinks=True):
+        """
+        os.stat or os.lstat result for the entry, cached.
+
+        :raises: OSError
+        """
+        if follow_symlinks:
+            if self._stat is None:
+                if self._dirent is not None:
+                    self._stat = self._dirent.stat()
+                else:
+                    self._stat = os.stat(self.path)
+            return self._stat
+        if self._lstat is None:
+            if self._dirent is not None:
+                self._lstat = self._dirent.stat(follow_symlinks=False)
+            else:
+                self._lstat = os.lstat(self.path)
+        return self._lstat
+
+    def _is_mode(self, s_isfunc, follow_symlinks):
+        try:
+            return s_isfunc(self.stat(follow_symlinks).st_mode)
+        except OSError:
+            return False
+
+    def is_dir(self, follow_symlinks=True):
+        """True iff entry is a directory. Same as os.path.isdir if follow_symlinks."""
+        if self._dirent is not None:
+            try:
+                return self._dirent.is_dir(follow_symlinks=follow_symlinks)
+            except OSError:
+                return False
+        return self._is_mode(stat.S_ISDIR, follow_symlinks)
+
+    def is_file(self, follow_symlinks=True):
+        """True iff entry is a regular file. Same as os.path.isfile if follow_symlinks."""
+        if self._dirent is not None:
+            try:
+                return self._dirent.is_file(follow_symlinks=follow_symlinks)
+            except OSError:
+                return False
+        return self._is_mode(stat.S_ISREG, follow_symlinks)
+
+    def is_symlink(self):
+        """True iff entry is a symlink. Same as os.path.islink."""
+        if self._dirent is not None:
+            try:
+                return self._dirent.is_symlink()
+            except OSError:
+                return False
+        return self._is_mode(stat.S_ISLNK, False)
+
+    def inode(self):
+        """
+        Inode of the entry. Does not follow symlinks.
+
+        Free on POSIX when scandir is used.
+        """
+        if self._dirent is not None:
+            return self._dirent.inode()
+        return self.stat(follow_symlinks=False).st_ino
+
+class _IndexDirent(object):
+    """
+    Mimics a scandir DirEntry from a TreeIndex row, so that it can be wrapped
+    by a FindEntry.
+
+    Only the stat fields stored in the index are set on the stat results,
+    all others are 0.
+    """
+
+    __slots__ = ('path', 'name', '_lstat', '_stat')
+
+    def __init__(self, path, name, mode, ino, dev, size, mtime):
+        self.path = path
+        self.name = name
+        self._lstat = os.stat_result((mode, ino, dev, 0, 0, 0, size, 0, mtime, 0))
+        self._stat = None
+
+    def stat(self, follow_symlinks=True):
+        if follow_symlinks and stat.S_ISLNK(self._lstat.st_mode):
+            if self._stat is None:
+                self._stat = os.stat(self.path)
+            return self._stat
+        return self._lstat
+
+    def is_dir(self, follow_symlinks=True):
+        return stat.S_ISDIR(self.stat(follow_symlinks).st_mode)
+
+    def is_file(self, follow_symlinks=True):
+        return stat.S_ISREG(self.stat(follow_symlinks).st_mode)
+
+    def is_symlink(self):
+        return stat.S_ISLNK(self._lstat.st_mode)
+
+    def inode(self):
+        return self._lstat.st_ino
+
+class TreeIndex(object):
+    """
+    Persistent sqlite index of the paths under a root directory.
+
+    Stores the name, mode, inode, device, size and mtime of every path under root.
+
+    Once the index is up to date, find and find_entries can answer from it
+    with the index kwarg instead of listing directories:
+
+        index = files.TreeIndex('/media/music.sqlite', '/media/music')
+        index.update()
+        for path in files.find('/media/music/rock', index=index):
+            print path
+
+    update only lists directories whose mtime changed since the last update,
+    which is what happens when children are added, removed or renamed.
+    Therefore, the stat data of files whose content changed since they were
+    indexed is not refreshed until their parent dir is listed again.
+
+    Symlinks to directories are indexed, but not followed.
+
+    Paths can be looked up by inode with paths_of_inode, and the inode of
+    paths that were removed or replaced by an update is remembered,
+    so that after a mass rename resolve finds where each old path went:
+
+        index.update()
+        #rename lots of files
+        index.update()
+        print index.resolve('/media/music/old name.mp3')
+
+    :param db_path: path of the sqlite database. Created if it does not exist.
+    :param root: root directory to index. Must be the same every time a given
+        db_path is used.
+    :raises: ValueError if db_path indexes a different root
+    """
+
+    def __init__(self, db_path, root):
+        if isinstance(root, str):
+            root = root.decode(sys.getfilesystemencoding())
+        self.root = os.path.abspath(root)
+        self.db_path = db_path
+        self.conn = sqlite3.connect(db_path)
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value TEXT
+            );
+            CREATE TABLE IF NOT EXISTS entries (
+                parent TEXT NOT NULL,
+                name TEXT NOT NULL,
+                mode INTEGER,
+                ino INTEGER,
+                dev INTEGER,
+                size INTEGER,
+                mtime REAL,
+                PRIMARY KEY (parent, name)
+            );
+            CREATE TABLE IF NOT EXISTS dirs (
+                relpath TEXT PRIMARY KEY,
+                mtime REAL
+            );
+            CREATE INDEX IF NOT EXISTS entries_inode ON entries (ino, dev);
+            CREATE TABLE IF NOT EXISTS gone (
+                relpath TEXT PRIMARY KEY,
+                ino INTEGER,
+                dev INTEGER
+            );
+        """)
+        row = self.conn.execute(
+                "SELECT value FROM meta WHERE key = 'root'").fetchone()
+        if row is None:
+            self.conn.execute(
+                    "INSERT INTO meta VALUES ('root', ?)", (self.root,))
+            self.conn.commit()
+        elif row[0] != self.root:
+            raise ValueError("index %s is for root %s, not %s"
+                    % (db_path, row[0], self.root))
+
+    def close(self):
+        self.conn.close()
+
+    def _relpath(self, path):
+        """
+        Path relative to the index root, or None if path is not under it.
+
+        The root itself is u''.
+        """
+        if isinstance(path, str):
+            path = path.decode(sys.getfilesystemencoding())
+        relpath = os.path.relpath(os.path.abspath(path), self.root)
+        if relpath == os.curdir:
+            return u''
+        if relpath == os.pardir or relpath.startswith(os.pardir + os.sep):
+            return None
+        return relpath
+
+    def update(self):
+        """
+        Brings the index up to date with the filesystem.
+
+        Stats every indexed directory, but only lists those whose mtime changed.
+
+        :returns: number of directories that were listed
+
+        >>> import tempfile, shutil
+        >>> d = tempfile.mkdtemp()
+        >>> os.makedirs(os.path.join(d, 'r', 'x'))
+        >>> open(os.path.join(d, 'r', 'x', 'child'), 'w').close()
+        >>> index = TreeIndex(os.path.join(d, 'index.sqlite'), os.path.join(d, 'r'))
+        >>> index.update()
+        2
+        >>> shutil.rmtree(os.path.join(d, 'r', 'x'))
+        >>> open(os.path.join(d, 'r', 'x'), 'w').close()
+        >>> index.update()
+        1
+        >>> index.conn.execute("SELECT parent, name FROM entries").fetchall()
+        [(u'', u'x')]
+        >>> index.conn.execute("SELECT relpath FROM dirs").fetchall()
+        [(u'',)]
+        >>> index.close()
+        >>> shutil.rmtree(d)
+        """
+        nlisted = self._update_dir(u'', self.root, os.stat(self.root))
+        self.conn.commit()
+        return nlisted
+
+    def _update_dir(self, relpath, path, dir_stat):
+
+        nlisted = 0
+        conn = self.conn
+        row = conn.execute(
+                "SELECT mtime FROM dirs WHERE relpath = ?", (relpath,)).fetchone()
+
+        if row is not None and row[0] == dir_stat.st_mtime:
+            subdirs = [ name for (name, mode) in conn.execute(
+                        "SELECT name, mode FROM entries WHERE parent = ?", (relpath,))
+                    if stat.S_ISDIR(mode) ]
+        else:
+            try:
+                entries = list_entries(path)
+            except OSError, exc:
+                sys.stderr.write(str(exc) + "\n")
+                return nlisted
+            nlisted += 1
+
+            new_names = set()
+            rows = []
+            subdirs = []
+            for entry in entries:
+                name = entry.name
+                if not isinstance(name, unicode):
+                    logging.warning("could not decode path, not indexed: %r" % entry.path)
+                    continue
+                try:
+                    st = entry.stat(follow_symlinks=False)
+                except OSError, exc:
+                    sys.stderr.write(str(exc) + "\n")
+                    continue
+                new_names.add(name)
+                rows.append( (relpath, name, st.st_mode, st.st_ino, st.st_dev,
+                        st.st_size, st.st_mtime) )
+                if stat.S_ISDIR(st.st_mode):
+                    subdirs.append(name)
+
+            new_stats = dict( (row[1], (stat.S_IFMT(row[2]),) + row[3:5]) for row in rows )
+            for (name, mode, ino, dev) in conn.execute(
+                    "SELECT name, mode, ino, dev FROM entries WHERE parent = ?",
+                    (relpath,)).fetchall():
+                if name not in new_names:
+                    self._delete(os.path.join(relpath, name), mode)
+                elif new_stats[name] != (stat.S_IFMT(mode), ino, dev):
+                    #replaced by another file, typically by a rename.
+                    #the inode of a removed file may be reused at once, so compare the type too
+                    if stat.S_ISDIR(mode):
+                        #the subtree of the old dir is not under this path anymore
+                        self._delete(os.path.join(relpath, name), mode)
+                    else:
+                        conn.execute(
+                                "INSERT OR REPLACE INTO gone VALUES (?, ?, ?)",
+                                (os.path.join(relpath, name), ino, dev))
+            conn.executemany(
+                    "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+            conn.execute(
+                    "INSERT OR REPLACE INTO dirs VALUES (?, ?)",
+                    (relpath, dir_stat.st_mtime))
+
+        for name in subdirs:
+            sub_relpath = os.path.join(relpath, name)
+            sub_path = os.path.join(path, name)
+            try:
+                sub_stat = os.lstat(sub_path)
+            except OSError:
+                continue #removed since listed. will be removed on next update
+            if stat.S_ISDIR(sub_stat.st_mode):
+                nlisted += self._update_dir(sub_relpath, sub_path, sub_stat)
+
+        return nlisted
+
+    def _delete(self, relpath, mode):
+        """
+        Removes relpath and, if it is a directory, all of its subtree from the index.
+
+        The inodes of the removed paths are kept in the gone table for resolve.
+        """
+        parent, name = os.path.split(relpath)
+        self.conn.execute(
+                "INSERT OR REPLACE INTO gone SELECT ?, ino, dev FROM entries "
+                "WHERE parent = ? AND name = ?", (relpath, parent, name))
+        self.conn.execute(
+                "DELETE FROM entries WHERE parent = ? AND name = ?", (parent, name))
+        if stat.S_ISDIR(mode):
+            #all strings that start with relpath + sep are in this range
+            subtree = (relpath, relpath + os.sep, relpath + unichr(ord(os.sep) + 1))
+            self.conn.execute(
+                    "INSERT OR REPLACE INTO gone SELECT parent || ? || name, ino, dev "
+                    "FROM entries WHERE parent = ? OR ( parent >= ? AND parent < ? )",
+                    (os.sep,) + subtree)
+            self.conn.execute(
+                    "DELETE FROM entries WHERE parent = ? OR ( parent >= ? AND parent < ? )",
+                    subtree)
+            self.conn.execute(
+                    "DELETE FROM dirs WHERE relpath = ? OR ( relpath >= ? AND relpath < ? )",
+                    subtree)
+
+    def inode_of(self, path):
+        """
+        Returns the (inode, device) of path according to the index, or None if not indexed.
+        """
+        relpath = self._relpath(path)
+        if not relpath:
+            return None
+        parent, name = os.path.split(relpath)
+        row = self.conn.execute(
+                "SELECT ino, dev FROM entries WHERE parent = ? AND name = ?",
+                (parent, name)).fetchone()
+        return tuple(row) if row is not None else None
+
+    def paths_of_inode(self, ino, dev=None):
+        """
+        Returns the list of indexed paths with the given inode.
+
+        There are several of them if the file has several hardlinks under root.
+
+        :param dev: device. if not given, paths with the given inode
+            on any device are returned.
+        """
+        if dev is None:
+            rows = self.conn.execute(
+                    "SELECT parent, name FROM entries WHERE ino = ?", (ino,))
+        else:
+            rows = self.conn.execute(
+                    "SELECT parent, name FROM entries WHERE ino = ? AND dev = ?", (ino, dev))
+        return [ os.path.join(self.root, parent, name) for (parent, name) in rows ]
+
+    def resolve(self, path):
+        """
+        Returns the current paths of the file that was at path.
+
+        If path was removed or replaced by an update, for instance because it was renamed,
+        this is where its inode is now. Else, it is path itself if it is indexed.
+
+        The paths are absolute. The list is empty if the file was not found,
+        for example because it was removed and not renamed.
+        """
+        relpath = self._relpath(path)
+        if not relpath:
+            return []
+        row = self.conn.execute(
+                "SELECT ino, dev FROM gone WHERE relpath = ?", (relpath,)).fetchone()
+        if row is not None:
+            paths = self.paths_of_inode(*row)
+            if paths:
+                return paths
+        row = self.inode_of(path)
+        if row is None:
+            return []
+        return self.paths_of_inode(*row)
+
+    def compact(self):
+        """
+        Forgets removed paths whose inode is not indexed anymore,
+        so resolve cannot find them anyway, and reclaims the space of the database.
+        """
+        self.conn.execute(
+                "DELETE FROM gone WHERE NOT EXISTS ( SELECT 1 FROM entries "
+                "WHERE entries.ino = gone.ino AND entries.dev = gone.dev )")
+        self.conn.commit()
+        self.conn.execute("VACUUM")
+
+    def list_entries(self, root, depth=1):
+        """
+        Same as files.list_entries, but answers from the index.
+
+        Falls back to files.list_entries if root was never listed by update.
+        """
+        relpath = self._relpath(root)
+        if relpath is not None and self.conn.execute(
+                "SELECT 1 FROM dirs WHERE relpath = ?", (relpath,)).fetchone():
+            return [ FindEntry(
+                        os.path.join(root, name), name, depth,
+                        _IndexDirent(os.path.join(root, name), name, *row) )
+                    for (name, row) in (
+                        (r[0], r[1:]) for r in self.conn.execute(
+                            "SELECT name, mode, ino, dev, size, mtime "
+                            "FROM entries WHERE parent = ?", (relpath,)) ) ]
+        return list_entries(root, depth)
 
 def find_books(roots, **kwargs):
     """helper method to find books"""
-    exts = ['pdf','djvu','djv','chm']
+    kwargs.setdefault('exts', ['pdf','djvu','djv','chm'])
+    kwargs.setdefault('type', 'f')
     for root in roots:
         for path in find(root, **kwargs):
-            if ( os.path.isfile(path)
-                    and extension(path) in exts ):
-                yield path
+            yield path
 
 def find_music(roots, **kwargs):
     """helper method to find music"""
-    exts = ['mp3','ogg','wma','flac']
+    kwargs.setdefault('exts', ['mp3','ogg','wma','flac'])
+    kwargs.setdefault('type', 'f')
     for root in roots:
         for path in find(root, **kwargs):
-            if ( os.path.isfile(path)
-                    and extension(path) in exts ):
-                yield path
+            yield path
+
+def extension(path):
+    """
+    returns the extension of path without the dot, or the empty string if there is none
+
+    >>> extension('a/b.tar.gz')
+    'gz'
+    >>> extension('a.b/c')
+    ''
+    """
+    return os.path.splitext(path)[1][1:]
+
 def split3(path):
     """returns a tuple (parent_dir, basename wihout extension, extension with dot) """
     parent_dir, bname = os.path.split(path)
@@ -462,10 +1403,102 @@ def inode(path):
     """returns inode of a given path"""
     return os.stat(path)[stat.ST_INO]
 
+class AtomicWriter(object):
+    """
+    File like object whose content replaces the file at path only once it is committed.
+
+    Data is written to a temporary file in the same directory as path,
+    which is renamed over path on commit. Since a rename is atomic,
+    path has either its old content or the entire new one, even if the process is killed.
+
+    The new file gets the permissions and, if possible, the owner and group of the
+    file it replaces. If path is a symlink, its target is replaced.
+
+    Used as a context manager, commits if the block ends normally, and discards otherwise:
+
+        with files.AtomicWriter('a.txt') as f:
+            for line in lines:
+                f.write(line)
+
+    :param fsync: if True, the data and the rename are flushed to disk
+        on commit, so that they survive a power loss. slower.
+    """
+
+    def __init__(self, path, mode='w', fsync=False):
+        self.path = os.path.realpath(path)
+        self.fsync = fsync
+        head, bname = os.path.split(self.path)
+        fd, self.tmp_path = tempfile.mkstemp(prefix='.%s.' % bname, suffix='.tmp', dir=head)
+        try:
+            try:
+                st = os.stat(self.path)
+            except OSError:
+                umask = os.umask(0)
+                os.umask(umask)
+                os.chmod(self.tmp_path, 0666 & ~umask)
+            else:
+                os.chmod(self.tmp_path, stat.S_IMODE(st.st_mode))
+                try:
+                    os.chown(self.tmp_path, st.st_uid, st.st_gid)
+                except OSError:
+                    pass #only root can give files to other users
+            self.file = os.fdopen(fd, mode)
+        except:
+            os.close(fd)
+            os.remove(self.tmp_path)
+            raise
+
+    def write(self, data):
+        self.file.write(data)
+
+    def writelines(self, lines):
+        self.file.writelines(lines)
+
+    def commit(self):
+        """Closes the temporary file and renames it to path."""
+        self.file.flush()
+        if self.fsync:
+            os.fsync(self.file.fileno())
+        self.file.close()
+        os.rename(self.tmp_path, self.path)
+        if self.fsync:
+            dir_fd = os.open(os.path.dirname(self.path), os.O_RDONLY)
+            try:
+                os.fsync(dir_fd)
+            finally:
+                os.close(dir_fd)
+
+    def discard(self):
+        """Closes and removes the temporary file. path is not modified."""
+        self.file.close()
+        os.remove(self.tmp_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.discard()
+
 def write(path,input,**kwargs):
-    f = open(path,'w')
-    f.write(input)
-    f.close()
+    """
+    Atomically replaces the content of the file at path by input. See AtomicWriter.
+
+    :param fsync: default: False. see AtomicWriter.
+
+    >>> d = tempfile.mkdtemp()
+    >>> path = os.path.join(d, 'a')
+    >>> write(path, 'ab')
+    >>> os.chmod(path, 0640)
+    >>> write(path, 'cd')
+    >>> read(path), oct(stat.S_IMODE(os.stat(path).st_mode)), os.listdir(d)
+    ('cd', '0640', ['a'])
+    >>> remove_recursive(d)
+    """
+    with AtomicWriter(path, fsync=kwargs.get('fsync', False)) as f:
+        f.write(input)
 
 def read(path,**kwargs):
     f = open(path,'r')
@@ -557,6 +1590,114 @@ def make_hardlinks(source_paths, destination_dir ):
     for source_path in source_paths:
         os.link(source_path, os.path.join(destination_dir, os.path.basename(source_path) ) )
 
+def files_equal(path1, path2, chunk_size=2**20):
+    """
+    Returns True iff the two files have the same contents, comparing them chunk by chunk.
+    """
+    with open(path1, 'rb') as f1:
+        with open(path2, 'rb') as f2:
+            if os.fstat(f1.fileno()).st_size != os.fstat(f2.fileno()).st_size:
+                return False
+            while True:
+                chunk1 = f1.read(chunk_size)
+                if chunk1 != f2.read(chunk_size):
+                    return False
+                if not chunk1:
+                    return True
+
+def _replace_with_hardlink(source, path):
+    """
+    Atomically replaces path by a hardlink to source.
+
+    The link is made at a temporary name in the directory of path, then renamed over path,
+    so that path always exists. The access and modification times of the directory are kept.
+    """
+    head, bname = os.path.split(path)
+    dir_st = os.stat(head or '.')
+    i = 0
+    while True:
+        tmp = os.path.join(head, '.%s.lntmp%d' % (bname, i))
+        try:
+            os.link(source, tmp)
+            break
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+            i += 1
+    try:
+        os.rename(tmp, path)
+    except OSError:
+        os.remove(tmp)
+        raise
+    os.utime(head or '.', (dir_st.st_atime, dir_st.st_mtime))
+
+def dedupe_hardlinks(groups, dry_run=False):
+    """
+    Replaces redundant copies of files by hardlinks, to save disk space.
+
+    For each group of files which should have the same contents, such as
+    a duplicates.DuplicateGroup, the file with the oldest modification time is kept,
+    and the other files are atomically replaced by hardlinks to it.
+    Files are only linked to a file of the same filesystem, so a group that spans
+    several filesystems is deduplicated separately on each of them.
+
+    Since contents are only known to be equal from their hash, files are compared byte
+    by byte before linking. Files that differ, or that were modified meanwhile, are left untouched.
+
+    Only the data of files which had no other hardlinks is freed: those bytes are
+    counted as reclaimed.
+
+    :param groups: iterable of iterables of paths, or of objects with a paths attribute
+    :param dry_run: if True, only compares the files and counts the bytes that would be reclaimed
+    :returns: (bytes reclaimed, list of error messages)
+
+    >>> import tempfile
+    >>> d = tempfile.mkdtemp()
+    >>> a, b, c = [ os.path.join(d, x) for x in 'abc' ]
+    >>> for path, data in ( (a, 'ab'), (b, 'ab'), (c, 'ac') ): open(path, 'w').write(data)
+    >>> dedupe_hardlinks([ [a, b, c] ])[0]
+    2
+    >>> os.path.samefile(a, b), os.path.samefile(a, c)
+    (True, False)
+    >>> remove_recursive(d)
+    """
+    reclaimed = 0
+    errors = []
+    for group in groups:
+        paths = getattr(group, 'paths', group)
+        stats = []
+        for path in paths:
+            try:
+                stats.append( (path, os.lstat(path)) )
+            except OSError, e:
+                errors.append("could not stat:\n%s\n\n%s" % (path, e))
+        #oldest file of each filesystem, in order of the input
+        stats.sort(key=lambda (path, st): st.st_mtime)
+        sources = {}
+        for path, st in stats:
+            sources.setdefault(st.st_dev, (path, st))
+        for path, st in stats:
+            source, source_st = sources[st.st_dev]
+            if st.st_ino == source_st.st_ino:
+                continue
+            try:
+                if not files_equal(source, path):
+                    errors.append("files differ, not linked:\n%s\n%s" % (source, path))
+                    continue
+                if not dry_run:
+                    new_st = os.lstat(path)
+                    if (new_st.st_ino, new_st.st_size, new_st.st_mtime) != (st.st_ino, st.st_size, st.st_mtime):
+                        errors.append("file modified during comparison, not linked:\n%s" % path)
+                        continue
+                    _replace_with_hardlink(source, path)
+            except (IOError, OSError), e:
+                errors.append("could not link:\n%s\n%s\n\n%s" % (source, path, e))
+                continue
+            logging.info("%s\n%s\n" % (source, path))
+            if st.st_nlink == 1:
+                reclaimed += st.st_size
+    return reclaimed, errors
+
 def generate_test_output(curPath,suffix):
     """ Generates test output file in the same directory as the file curPath, using the same name as it + a given suffix """
     test_output_dir = os.path.dirname(curPath)
@@ -588,23 +1729,30 @@ def strip_basename_forbidden_chars(s):
 
 remove_heading_hyphen_whitespace = [re.compile(ur"^[-\s]+", re.UNICODE),""]
 remove_trailling_dot_whitespace = [re.compile(ur"[\.\s]+$", re.UNICODE),""]
+remove_trailling_whitespace_unicode = [re.compile(ur"\s+$", re.UNICODE),""]
+whitespaces_to_single_space_unicode = [re.compile(ur"\s+", re.UNICODE)," "]
+#done in a single scan. the matches of these never overlap
+_nice_basename_noext_pipeline = ResubPipeline([[
+    remove_heading_hyphen_whitespace,
+    #remove_trailling_dot_whitespace,
+    remove_trailling_whitespace_unicode,
+    whitespaces_to_single_space_unicode,
+]])
 def nice_basename_stripped(bname):
     """
     Creates a nice and portable basename by simply stripping away bad things.
 
     If stripped things contain important data and you still need the portability,
     consider TODO
+
+    >>> nice_basename_stripped(u' - a:  b  .txt')
+    u'a b.txt'
     """
     bname = strip_basename_forbidden_chars(bname)
 
     bname_noext, dotext = os.path.splitext(bname)
-    
-    bname_noext = resub(remove_heading_hyphen_whitespace,bname_noext)
-
-    #bname_noext = resub(remove_trailling_dot_whitespace,bname_noext)
-    bname_noext = remove_trailling_whitespace(bname_noext)
 
-    bname_noext = whitespaces_to_single_space(bname_noext)
+    bname_noext = _nice_basename_noext_pipeline.sub(bname_noext)
 
     return bname_noext + dotext
 
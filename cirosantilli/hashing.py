@@ -0,0 +1,563 @@
+#!/usr/bin/env python
+
+"""
+File hashing with bounded memory.
+
+Files are read in fixed size chunks into a buffer that is reused between files
+of a same thread, so hashing huge files only uses chunk_size bytes of memory.
+
+Algorithms:
+
+- all those of hashlib, such as sha1, sha256 and md5
+- blake2b, blake2s: from hashlib on python 3.6+, else from the pyblake2 package
+- xxh32, xxh64, xxh128: very fast non cryptographic hashes from the xxhash package
+
+Optional packages are only imported when their algorithm is used.
+"""
+
+import collections
+import hashlib
+import os
+import Queue
+import sqlite3
+import sys
+import threading
+
+import argparse_extras
+
+KBYTE = 2**10
+MBYTE = 2**20
+
+CHUNK_SIZE = MBYTE
+SAMPLE_SIZE = 64*KBYTE
+
+_local = threading.local()
+
+def _buffer(chunk_size):
+    """returns a memoryview of a buffer of chunk_size bytes, reused for the current thread"""
+    view = getattr(_local, 'view', None)
+    if view is None or len(view) != chunk_size:
+        view = _local.view = memoryview(bytearray(chunk_size))
+    return view
+
+def new_hash(algorithm='sha1'):
+    """
+    Returns a new hash object for the given algorithm name.
+
+    The returned object has the update and hexdigest methods of hashlib objects.
+
+    :raises: ValueError if the algorithm is unknown or its package is not installed
+
+    >>> new_hash('sha1').hexdigest()
+    'da39a3ee5e6b4b0d3255bfef95601890afd80709'
+    """
+    try:
+        return hashlib.new(algorithm)
+    except ValueError:
+        pass
+    if algorithm in ('blake2b', 'blake2s'):
+        try:
+            import pyblake2
+        except ImportError:
+            raise ValueError("%s needs python 3.6+ or the pyblake2 package" % algorithm)
+        return getattr(pyblake2, algorithm)()
+    if algorithm in ('xxh32', 'xxh64', 'xxh128'):
+        try:
+            import xxhash
+        except ImportError:
+            raise ValueError("%s needs the xxhash package" % algorithm)
+        return getattr(xxhash, algorithm)()
+    raise ValueError("unknown hash algorithm: %s" % algorithm)
+
+def update_from_file(hash_obj, f, max_bytes=None, chunk_size=CHUNK_SIZE):
+    """
+    Updates hash_obj with at most max_bytes bytes read from the file object f,
+    chunk_size bytes at a time.
+
+    :param max_bytes: if None or infinite, reads until the end of the file.
+    :returns: number of bytes read
+    """
+    view = _buffer(chunk_size)
+    nread = 0
+    if max_bytes is None or max_bytes == float("inf"):
+        max_bytes = None
+    while max_bytes is None or nread < max_bytes:
+        if max_bytes is None or max_bytes - nread >= chunk_size:
+            n = f.readinto(view)
+        else:
+            n = f.readinto(view[:max_bytes - nread])
+        if not n:
+            break
+        hash_obj.update(view[:n])
+        nread += n
+    return nread
+
+def hash_file(path, algorithm='sha1', max_bytes=None, chunk_size=CHUNK_SIZE):
+    """
+    Returns the hexadecimal digest of the file at path.
+
+    :param max_bytes: if given, only hashes the first max_bytes bytes of the file.
+
+    >>> import tempfile
+    >>> f = tempfile.NamedTemporaryFile()
+    >>> f.write('ab'); f.flush()
+    >>> hash_file(f.name) == hashlib.sha1('ab').hexdigest()
+    True
+    >>> hash_file(f.name, 'sha256', max_bytes=1, chunk_size=1) == hashlib.sha256('a').hexdigest()
+    True
+    """
+    hash_obj = new_hash(algorithm)
+    with open(path, 'rb') as f:
+        update_from_file(hash_obj, f, max_bytes, chunk_size)
+    return hash_obj.hexdigest()
+
+def sample_hash_file(path, algorithm='sha1', sample_size=SAMPLE_SIZE, chunk_size=CHUNK_SIZE):
+    """
+    Returns a cheap hexadecimal fingerprint of the file at path, which only reads
+    its first and last sample_size bytes.
+
+    The hash is taken over the decimal file size, a null byte, and the two samples.
+    Files of up to 2 * sample_size bytes are read entirely.
+
+    Different files may have the same fingerprint if they only differ in the middle,
+    so use it only to find candidates, or when that risk is acceptable.
+
+    >>> import tempfile
+    >>> f = tempfile.NamedTemporaryFile()
+    >>> f.write('abc'); f.flush()
+    >>> sample_hash_file(f.name) == hashlib.sha1('3\\0abc').hexdigest()
+    True
+    >>> sample_hash_file(f.name, sample_size=1) == hashlib.sha1('3\\0ac').hexdigest()
+    True
+    """
+    hash_obj = new_hash(algorithm)
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        hash_obj.update(str(size) + '\0')
+        if size <= 2 * sample_size:
+            update_from_file(hash_obj, f, None, chunk_size)
+        else:
+            update_from_file(hash_obj, f, sample_size, chunk_size)
+            f.seek(-sample_size, os.SEEK_END)
+            update_from_file(hash_obj, f, sample_size, chunk_size)
+    return hash_obj.hexdigest()
+
+def file_hasher(algorithm='sha1', max_bytes=None, sample_size=None, chunk_size=CHUNK_SIZE):
+    """
+    Returns a function : path --> hexadecimal digest with the given parameters.
+
+    :param sample_size: if given, uses sample_hash_file with this sample size,
+        and max_bytes is ignored. else, uses hash_file.
+    :raises: ValueError if the algorithm is not available, see new_hash.
+        checked here, so that it is not only found when hashing the first file.
+
+    >>> file_hasher('nosuchhash')
+    Traceback (most recent call last):
+    ...
+    ValueError: unknown hash algorithm: nosuchhash
+    """
+    new_hash(algorithm)
+    if sample_size:
+        return lambda path: sample_hash_file(path, algorithm, sample_size, chunk_size)
+    return lambda path: hash_file(path, algorithm, max_bytes, chunk_size)
+
+class _HashJob(object):
+
+    __slots__ = ('path', 'digest', 'error', 'done')
+
+    def __init__(self, path):
+        self.path = path
+        self.digest = None
+        self.error = None
+        self.done = threading.Event()
+
+def _hash_worker(hasher, tasks):
+    while True:
+        job = tasks.get()
+        if job is None:
+            return
+        try:
+            job.digest = hasher(job.path)
+        except Exception, e:
+            #also other exceptions, which the consumer re-raises, so that it never waits forever
+            job.error = e
+        finally:
+            job.done.set()
+
+def _job_result(job):
+    """waits for job, and returns its (path, digest, error), or raises its error if not an IO error"""
+    job.done.wait()
+    if job.error is not None and not isinstance(job.error, (IOError, OSError)):
+        raise job.error
+    return job.path, job.digest, job.error
+
+def hash_paths(paths, hasher, workers=1, queue_size=None):
+    """
+    Hashes paths with hasher, and yields (path, digest, error) tuples in the order of paths.
+
+    If hashing a path fails with IOError or OSError, digest is None and error
+    is the exception. Else, error is None. Other exceptions are raised.
+
+    With more than one worker, hashing is done by a pool of threads, which run
+    in parallel since hashlib releases the GIL while hashing large buffers.
+    paths is consumed lazily, and at most queue_size paths are being hashed
+    or waiting to be output at any time, so paths may be a generator
+    such as files.find that runs while files are hashed.
+
+    :param hasher: function : path --> digest, typically made with file_hasher
+    :param queue_size: default: 4 * workers
+
+    >>> import tempfile
+    >>> f = tempfile.NamedTemporaryFile()
+    >>> results = list(hash_paths([f.name, '/nonexistent'] * 3, hash_file, workers=2))
+    >>> [ (digest, error is None) for (path, digest, error) in results[:2] ]
+    [('da39a3ee5e6b4b0d3255bfef95601890afd80709', True), (None, False)]
+    >>> [ (path, digest) for (path, digest, error) in results ] == [ (f.name, results[0][1]), ('/nonexistent', None) ] * 3
+    True
+    >>> def bad_hasher(path):
+    ...     raise ValueError('bad')
+    >>> list(hash_paths([f.name] * 3, bad_hasher, workers=2))
+    Traceback (most recent call last):
+    ...
+    ValueError: bad
+    """
+
+    if workers <= 1:
+        for path in paths:
+            try:
+                yield path, hasher(path), None
+            except (IOError, OSError), e:
+                yield path, None, e
+        return
+
+    if queue_size is None:
+        queue_size = 4 * workers
+    tasks = Queue.Queue()
+    threads = []
+    for i in xrange(workers):
+        thread = threading.Thread(target=_hash_worker, args=(hasher, tasks))
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+
+    pending = collections.deque()
+    try:
+        for path in paths:
+            job = _HashJob(path)
+            tasks.put(job)
+            pending.append(job)
+            while pending and ( len(pending) >= queue_size or pending[0].done.is_set() ):
+                yield _job_result(pending.popleft())
+        while pending:
+            yield _job_result(pending.popleft())
+    finally:
+        for thread in threads:
+            tasks.put(None)
+        for thread in threads:
+            thread.join()
+
+OUTPUT_FORMATS = ('text', 'sum', 'null')
+
+def format_hash_record(output_format, path, digest, inode=None):
+    """
+    Formats one output record of the find_path_*sha1 scripts.
+
+    Formats:
+
+    - text: path, inode if given, and digest, each followed by a newline,
+        then an empty line. for humans.
+    - sum: same as sha1sum and similar tools: digest, two spaces, path, newline.
+        the output can be checked with `sha1sum -c`. inode is not output.
+    - null: digest, inode if given, and path, see argparse_extras.null_record.
+
+    >>> format_hash_record('null', 'a', 'ff', 2) == 'ff\\t2\\ta\\0'
+    True
+    """
+    if output_format == 'text':
+        if inode is None:
+            return '%s\n%s\n\n' % (path, digest)
+        return '%s\n%d\n%s\n\n' % (path, inode, digest)
+    if output_format == 'sum':
+        return '%s  %s\n' % (digest, path)
+    if output_format == 'null':
+        if inode is None:
+            return argparse_extras.null_record(digest, path)
+        return argparse_extras.null_record(digest, inode, path)
+    raise ValueError("unknown output format: %s" % output_format)
+
+def hash_params(algorithm='sha1', max_bytes=None, sample_size=None):
+    """
+    Returns a string that identifies the digests made by file_hasher
+    with the given parameters, for HashCache.
+
+    >>> hash_params('sha1', float('inf')) == hash_params()
+    True
+    >>> hash_params('md5', 10)
+    'md5:max_bytes=10:sample_size=0'
+    """
+    if sample_size:
+        max_bytes = None
+    if max_bytes == float("inf"):
+        max_bytes = None
+    return '%s:max_bytes=%s:sample_size=%d' % (
+            algorithm, max_bytes or 'all', sample_size or 0)
+
+def _mtime_ns(st):
+    return int(round(st.st_mtime * 10**9))
+
+class HashCache(object):
+    """
+    Persistent sqlite cache of file digests.
+
+    Digests are keyed by device, inode, size and mtime of the file,
+    and by the hash parameters given by hash_params.
+    Unchanged files are therefore found even after they are renamed,
+    which is the main use case: hashing a tree before each mass rename.
+
+    The last absolute path at which each file was seen is also stored,
+    to be able to prune entries of files which do not exist anymore,
+    from any current directory.
+
+    Can be used from several threads.
+
+    Usage:
+
+        cache = HashCache('~/.hashes.sqlite')
+        params = hash_params('sha1')
+        hasher = cache.cached_hasher(file_hasher('sha1'), params)
+        for path, digest, error in hash_paths(paths, hasher, workers=4):
+            ...
+        cache.close()
+
+    >>> import tempfile, shutil
+    >>> d = tempfile.mkdtemp()
+    >>> path = os.path.join(d, 'f')
+    >>> open(path, 'w').write('a')
+    >>> cache = HashCache(os.path.join(d, 'cache.sqlite'))
+    >>> calls = []
+    >>> def hasher(p):
+    ...     calls.append(p)
+    ...     return hash_file(p)
+    >>> cached = cache.cached_hasher(hasher, hash_params())
+    >>> cached(path) == cached(path) == hash_file(path)
+    True
+    >>> len(calls)
+    1
+    >>> cwd = os.getcwd()
+    >>> os.chdir(d)
+    >>> cached('f') == hash_file(path)
+    True
+    >>> os.chdir('/')
+    >>> cache.prune()
+    0
+    >>> os.chdir(cwd)
+    >>> os.remove(path)
+    >>> cache.prune()
+    1
+    >>> shutil.rmtree(d)
+    """
+
+    COMMIT_EVERY = 1000
+
+    def __init__(self, db_path):
+        self.db_path = os.path.expanduser(db_path)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS hashes (
+                dev INTEGER,
+                ino INTEGER,
+                size INTEGER,
+                mtime_ns INTEGER,
+                params TEXT,
+                digest TEXT,
+                path BLOB,
+                PRIMARY KEY (dev, ino, size, mtime_ns, params)
+            )
+        """)
+        self.uncommitted = 0
+        self.mismatches = []
+        self.encoding = sys.getfilesystemencoding()
+
+    def _key(self, st, params):
+        return (st.st_dev, st.st_ino, st.st_size, _mtime_ns(st), params)
+
+    def get(self, st, params):
+        """
+        Returns the cached digest for the file with the given os.stat result, or None.
+        """
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT digest FROM hashes WHERE "
+                "dev = ? AND ino = ? AND size = ? AND mtime_ns = ? AND params = ?",
+                self._key(st, params)).fetchone()
+        if row is None:
+            return None
+        return str(row[0])
+
+    def put(self, st, params, digest, path):
+        """
+        Stores the digest of the file with the given os.stat result.
+        """
+        path = os.path.abspath(path)
+        if isinstance(path, unicode):
+            path = path.encode(self.encoding)
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?, ?, ?)",
+                self._key(st, params) + (digest, buffer(path)))
+            self.uncommitted += 1
+            if self.uncommitted >= self.COMMIT_EVERY:
+                self.conn.commit()
+                self.uncommitted = 0
+
+    def cached_hasher(self, hasher, params, verify=False):
+        """
+        Returns a function : path --> digest that returns the cached digest
+        of path if there is one, and else calls hasher and caches the result.
+
+        :param params: identifies hasher. see hash_params.
+        :param verify: if True, always calls hasher. if the digest differs from
+            the cached one, appends (path, cached digest, new digest) to self.mismatches,
+            and caches the new digest. useful to detect corruption, or changes
+            made without changing the mtime.
+        """
+        def cached(path):
+            st = os.stat(path)
+            digest = self.get(st, params)
+            if digest is not None and not verify:
+                self.put(st, params, digest, path) #update the last seen path
+                return digest
+            new_digest = hasher(path)
+            if digest is not None and digest != new_digest:
+                with self.lock:
+                    self.mismatches.append( (path, digest, new_digest) )
+            if digest != new_digest or digest is None:
+                self.put(st, params, new_digest, path)
+            return new_digest
+        return cached
+
+    def prune(self):
+        """
+        Removes the entries whose last seen path does not exist anymore,
+        or is a different or modified file.
+
+        :returns: number of entries removed
+        """
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT rowid, dev, ino, size, mtime_ns, path FROM hashes").fetchall()
+            removed = []
+            for row in rows:
+                try:
+                    st = os.stat(str(row[5]))
+                except OSError:
+                    removed.append( (row[0],) )
+                    continue
+                if (st.st_dev, st.st_ino, st.st_size, _mtime_ns(st)) != tuple(row[1:5]):
+                    removed.append( (row[0],) )
+            self.conn.executemany("DELETE FROM hashes WHERE rowid = ?", removed)
+            self.conn.commit()
+            self.uncommitted = 0
+        return len(removed)
+
+    def compact(self):
+        """
+        Rewrites the database file to reclaim space, for example after a prune.
+        """
+        with self.lock:
+            self.conn.commit()
+            self.uncommitted = 0
+            self.conn.execute("VACUUM")
+
+    def close(self):
+        with self.lock:
+            self.conn.commit()
+            self.conn.close()
+
+def sha1_hex_file(filepath, max_bytes=None):
+    """
+    Returns the SHA1 of a given filepath in hexadecimal.
+
+    Opt-args:
+
+    * max_bytes. If given, reads at most max_bytes bytes from the file.
+    """
+    return hash_file(filepath, 'sha1', max_bytes)
+
+def add_hash_arguments(parser):
+    """
+    Adds the options used by file_hasher_from_args to an argparse parser.
+    """
+    parser.add_argument('-a', '--algorithm',
+        default='sha1',
+        help="hash algorithm: any of hashlib, blake2b, blake2s, xxh32, xxh64 or xxh128. "
+            "default: sha1")
+
+    parser.add_argument('-s', '--sample-size',
+        type=int,
+        default=None,
+        help="if given, hashes only the size and the first and last SAMPLE_SIZE bytes of each file. "
+            "much faster for large files, but only a fingerprint")
+
+    parser.add_argument('-j', '--workers',
+        type=int,
+        default=1,
+        help="number of files hashed in parallel. default: 1")
+
+    parser.add_argument('-c', '--cache',
+        default=None,
+        help="path of a HashCache database. files whose device, inode, size and mtime "
+            "did not change since they were hashed with the same parameters are not hashed again")
+
+    parser.add_argument('--cache-verify',
+        action='store_true',
+        default=False,
+        help="hash all files even if cached, and report on stderr those whose digest "
+            "differs from the cached one")
+
+    parser.add_argument('--cache-prune',
+        action='store_true',
+        default=False,
+        help="before hashing, remove cache entries of files that changed or do not exist anymore, "
+            "and compact the cache")
+
+    parser.add_argument('-f', '--format',
+        choices=OUTPUT_FORMATS,
+        default='text',
+        help="output format. text: human readable. "
+            "sum: same as sha1sum. null: null terminated, tab separated records")
+
+def file_hasher_from_args(args, max_bytes=None):
+    """
+    Returns (hasher, cache) from the options added by add_hash_arguments.
+
+    cache is None if no cache was given. else, it must be closed after hashing,
+    and the mismatches found by --cache-verify are in cache.mismatches.
+
+    :raises: ValueError if the algorithm is not available
+    """
+    hasher = file_hasher(args.algorithm, max_bytes, args.sample_size)
+    if not args.cache:
+        return hasher, None
+    cache = HashCache(args.cache)
+    if args.cache_prune:
+        cache.prune()
+        cache.compact()
+    hasher = cache.cached_hasher(
+        hasher,
+        hash_params(args.algorithm, max_bytes, args.sample_size),
+        verify=args.cache_verify,
+    )
+    return hasher, cache
+
+def report_mismatches(cache):
+    """closes cache, and writes the mismatches it found to stderr"""
+    cache.close()
+    for path, cached_digest, new_digest in cache.mismatches:
+        sys.stderr.write("digest changed but stat did not:\n%s\ncached: %s\nnew:    %s\n\n"
+                % (path, cached_digest, new_digest))
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -1,9 +1,16 @@
 #!/usr/bin/env python
 
+import os
+import subprocess
+import sys
+
 from cirosantilli import files
 import argparse_extras
 import logging
 
+#overwritten by each run, so that the last run can be undone
+MANIFEST_DEFAULT = '~/.move_manifest.jsonl'
+
 def git_mv(old,new):
     """git mv"""
     import subprocess
@@ -22,6 +29,121 @@ def git_mv(old,new):
     )
     return_code = process.wait()
 
+class GitMvBatch(object):
+    """mv_func for files.move that does the same as git mv, but updates the git index
+    in batches instead of once per path.
+
+    git mv loads and rewrites the entire index for each path, which is very slow
+    for large numbers of renames in large repositories.
+
+    Instead, the index is read once with git ls-files, each rename is done
+    on the filesystem immediately and tracked in memory, and all the
+    resulting index changes are written with a single git update-index --index-info
+    every batch_size renames, and when flush is called.
+
+    Like git mv, paths which are not tracked, and directories that contain
+    no tracked files, are not renamed, and an exception is raised.
+
+    Usage:
+
+        mv_func = GitMvBatch()
+        files.move(paths, rename_func, do_move=True, mv_func=mv_func)
+
+    files.move calls flush when done.
+
+    :param batch_size: maximum number of renames between index updates
+    :type batch_size: int
+    """
+
+    def __init__(self, batch_size=10000):
+        self.batch_size = batch_size
+        self.top = None
+        self.index = None
+        self.changed = {}
+        self.nrenames = 0
+        self.null_sha = '0' * 40
+        self.encoding = sys.getfilesystemencoding()
+
+    def _git(self, args, input=None):
+        process = subprocess.Popen(
+            ['git'] + args,
+            cwd=self.top,
+            shell=False,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE
+        )
+        stdout, stderr = process.communicate(input)
+        if process.returncode != 0:
+            raise Exception("git %s failed:\n%s" % (' '.join(args), stderr))
+        return stdout
+
+    def _load(self):
+        """reads the index into self.index: relpath -> (mode, sha)"""
+        self.top = self._git(['rev-parse', '--show-toplevel']).rstrip('\n')
+        self.index = {}
+        for record in self._git(['ls-files', '-s', '-z']).split('\0'):
+            if record:
+                info, path = record.split('\t', 1)
+                mode, sha, stage = info.split(' ')
+                self.index[path] = (mode, sha)
+                self.null_sha = '0' * len(sha)
+
+    def _relpath(self, path):
+        if isinstance(path, unicode):
+            path = path.encode(self.encoding)
+        return os.path.relpath(os.path.abspath(path), self.top)
+
+    def __call__(self, old, new):
+        if self.index is None:
+            self._load()
+        old_relpath = self._relpath(old)
+        new_relpath = self._relpath(new)
+
+        if old_relpath in self.index:
+            moved = [ (old_relpath, new_relpath) ]
+        else:
+            prefix = old_relpath + '/'
+            moved = [ (path, new_relpath + path[len(old_relpath):])
+                    for path in self.index if path.startswith(prefix) ]
+        if not moved:
+            raise Exception("not under version control: %s" % old)
+
+        os.rename(old, new)
+
+        for old_path, new_path in moved:
+            info = self.index.pop(old_path)
+            self.index[new_path] = info
+            self.changed[old_path] = None
+            self.changed[new_path] = info
+
+        self.nrenames += 1
+        if self.nrenames >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """
+        writes the pending renames to the git index
+
+        :returns: list of error messages
+        """
+        if not self.changed:
+            return []
+        records = []
+        for path, info in self.changed.iteritems():
+            if info is None:
+                records.append('0 %s\t%s\0' % (self.null_sha, path))
+            else:
+                records.append('%s %s\t%s\0' % (info[0], info[1], path))
+        try:
+            self._git(['update-index', '-z', '--index-info'], ''.join(records))
+        except Exception, e:
+            return [ "could not update git index for %d paths\n\n%s" % (len(records), e) ]
+        finally:
+            self.changed = {}
+            self.nrenames = 0
+        return []
+
 def move_argparse(rename_func, **kwargs):
     """Convenient standard command line interface to rename files.
 
@@ -82,6 +204,23 @@ def move_argparse(rename_func, **kwargs):
 
     :type add_act_full_path: boolean. 
 
+    :param rename_func_factory: default: None
+
+        lambda (args)
+
+        if given, called once with the args output by parser.parse_args(),
+        and must return the rename function to use instead of rename_func.
+
+        the returned function is called with the full path only:
+        func_arg_controller, act_noext_only and act_basename_only are not used,
+        so it must implement the act_on_extension and act_full_path options itself.
+
+        this allows to do expensive preparations such as regex compilation
+        once per run instead of once per path, and to avoid the overhead
+        of nested decorators.
+
+        as in files.move, the function may return only the new basename.
+
     # kwargs
 
         all kwargs accepted by argpase.ArgumentParser are passed to it
@@ -92,6 +231,7 @@ def move_argparse(rename_func, **kwargs):
         - add kwarg that adds both ext only and bname only
     """
 
+    rename_func_factory = kwargs.pop("rename_func_factory", None)
     add_act_noext_only = kwargs.pop("add_act_noext_only", None)
     add_act_full_path = kwargs.pop("add_act_full_path", None)
     add_input_full_path = kwargs.pop("add_input_full_path", None)
@@ -126,14 +266,43 @@ def move_argparse(rename_func, **kwargs):
         help='if given does a git mv rename instead of normal rename',
     )
 
+    parser.add_argument(
+        '-S',
+        '--stream',
+        action='store_true',
+        default=False,
+        help='if given, paths are not sorted, and are processed while they are read from stdin. '
+            'children must be given before their parent dirs, as with find -depth',
+    )
+
+    parser.add_argument(
+        '-J',
+        '--journal',
+        default=None,
+        help='if given, path of a journal of the renames done, '
+            'which can be resumed or rolled back with move_journal.py if interrupted',
+    )
+
+    parser.add_argument(
+        '-M',
+        '--manifest',
+        default=MANIFEST_DEFAULT,
+        help='path of the manifest of the renames done, written if -D is given and anything is renamed, '
+            'which can be undone with `move_journal.py undo`. '
+            'an empty string disables it. default: %(default)s',
+    )
+
     args = parser.parse_args()
 
-    paths = argparse_extras.get_paths_from_stdin_and_argv(args)
+    paths = argparse_extras.get_paths_from_stdin_and_argv(args, stream=args.stream)
 
-    if add_act_noext_only and not args.act_on_extension:
-        rename_func = files.act_noext_only(rename_func)
-    if add_act_full_path and not args.act_full_path:
-        rename_func = files.act_basename_only(rename_func)
+    if rename_func_factory is not None:
+        rename_func = rename_func_factory(args)
+    else:
+        if add_act_noext_only and not args.act_on_extension:
+            rename_func = files.act_noext_only(rename_func)
+        if add_act_full_path and not args.act_full_path:
+            rename_func = files.act_basename_only(rename_func)
 
     logging.basicConfig(
         format='%(message)s',
@@ -142,9 +311,15 @@ def move_argparse(rename_func, **kwargs):
 
     move_kwargs = {}
     move_kwargs['do_move'] = args.not_dry_run
-    move_kwargs['func_args'], move_kwargs['func_kwargs'] = func_arg_controller(args)
+    if rename_func_factory is None:
+        move_kwargs['func_args'], move_kwargs['func_kwargs'] = func_arg_controller(args)
     if args.git_mv:
-        move_kwargs['mv_func'] = git_mv
+        move_kwargs['mv_func'] = GitMvBatch()
+    move_kwargs['journal'] = args.journal
+    if args.manifest:
+        move_kwargs['manifest'] = os.path.expanduser(args.manifest)
+    if args.stream:
+        move_kwargs['sort_func'] = None
 
     files.move(
         paths,
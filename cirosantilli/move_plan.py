@@ -0,0 +1,510 @@
+#!/usr/bin/env python
+
+"""
+Two phase batch renames.
+
+First the entire plan is built from all the (old, new) pairs:
+collisions, chains (a -> b, b -> c) and cycles (a -> b, b -> a) are detected,
+and an order of renames that works is found, using temporary names to break cycles.
+
+Then the plan is applied, optionally writing an append only journal,
+so that an interrupted run can be resumed or rolled back with resume_move and rollback_move.
+
+Journal format: one JSON object per line:
+
+    {"step": 0, "op": "mv", "src": "/a", "dst": "/b"}   one line per planned step
+    {"begin": true}                                    all steps were written
+    {"done": 0}                                        one line per applied step
+    {"end": true}                                      all steps were tried
+
+Independently of the journal, a manifest of the renames that were done can be
+written, so that the batch can be undone later with undo_move.
+Manifest format: one JSON object per rename done, in the order they were done:
+
+    {"ino": 1234, "old": "/a", "new": "/b"}
+"""
+
+import collections
+import json
+import logging
+import os
+
+from files import remove_recursive
+from filename_rules import collision_key
+
+def _listdir_set(path):
+    try:
+        return set(os.listdir(path))
+    except OSError:
+        return set()
+
+class MovePlan(object):
+    """
+    An ordered list of steps that do a batch of renames.
+
+    Each step is a tuple (op, src, dst), where op is:
+
+    - 'mv': rename src to dst
+    - 'rm': remove src, which is an existing path in the way of a rename.
+        dst is None. only if overwrite.
+
+    Moves whose new path is taken, either by an existing path that will not
+    be moved away or by an earlier move of the batch, are dropped, and a message
+    is added to warnings.
+
+    Existence of new paths is checked by listing each of their parent directories once,
+    not with one stat per path. Only new paths that differ from a listed name
+    just in case or unicode normalization are also checked with a stat,
+    since they exist on case insensitive or normalizing filesystems.
+
+    Steps are ordered so that for each old path, the moves that free its new path come first.
+    Such a chain of moves, or a cycle, is done at the position of its last member in the input,
+    and apart from that, the order of the input moves is kept, so give children before
+    their parent directories.
+
+    :param moves: (old_path, new_path) pairs.
+    :type moves: iterable of pairs of strings
+    :param overwrite: if True, existing paths in the way are removed instead of
+        dropping the move.
+
+    >>> import tempfile, shutil
+    >>> d = tempfile.mkdtemp()
+    >>> a, b, c = [ os.path.join(d, x) for x in 'abc' ]
+    >>> for p in (a, b): open(p, 'w').write(p)
+    >>> plan = MovePlan([ (a, b), (b, a), (c, a) ])
+    >>> len(plan.steps), len(plan.warnings)
+    (3, 1)
+    >>> plan.apply()
+    []
+    >>> open(a).read() == b, open(b).read() == a
+    (True, True)
+    >>> plan = MovePlan([ (b, c), (a, b) ])
+    >>> [ os.path.basename(src) for (op, src, dst) in plan.steps ]
+    ['b', 'a']
+    >>> plan = MovePlan([ (a, b), (b, c) ])
+    >>> [ os.path.basename(src) for (op, src, dst) in plan.steps ]
+    ['b', 'a']
+    >>> shutil.rmtree(d)
+
+    A chain of directories, whose children are renamed in the same batch:
+
+    >>> d = tempfile.mkdtemp()
+    >>> for x in ('b', 'c'): os.makedirs(os.path.join(d, x, 'z'))
+    >>> b, c, a = [ os.path.join(d, x) for x in 'bca' ]
+    >>> MovePlan([ (os.path.join(c, 'z'), os.path.join(c, 'y')), (c, b),
+    ...            (os.path.join(b, 'z'), os.path.join(b, 'y')), (b, a) ]).apply()
+    []
+    >>> sorted(os.listdir(a)), sorted(os.listdir(b))
+    (['y'], ['y'])
+    >>> shutil.rmtree(d)
+    """
+
+    TMP_FORMAT = '.%s.mvtmp%d'
+
+    def __init__(self, moves, overwrite=False):
+        self.overwrite = overwrite
+        self.warnings = []
+        self.steps = []
+        self._dir_cache = {}
+        self._build(self._validate(moves))
+
+    def _exists(self, path):
+        head, bname = os.path.split(path)
+        listing = self._dir_cache.get(head)
+        if listing is None:
+            names = _listdir_set(head)
+            listing = self._dir_cache[head] = (names, set( collision_key(name) for name in names ))
+        names, keys = listing
+        if bname in names:
+            return True
+        #on case insensitive or normalizing filesystems, such as vfat or macos,
+        #a name that only collides with a listed one also exists
+        return collision_key(bname) in keys and os.path.lexists(path)
+
+    def _add_exists(self, path):
+        head, bname = os.path.split(path)
+        names, keys = self._dir_cache[head]
+        names.add(bname)
+        keys.add(collision_key(bname))
+
+    def _validate(self, moves):
+        """
+        Drops invalid moves until all remaining ones can be done.
+
+        Dropping a move keeps its old path in place, which may block other moves,
+        so iterate until nothing changes.
+        """
+
+        sources = set()
+        unique_moves = []
+        for old, new in moves:
+            if old == new:
+                continue
+            if old in sources:
+                self.warnings.append("path given twice. rename skipped\nold path: %s\nnew path: %s"
+                        % (old, new))
+                continue
+            sources.add(old)
+            unique_moves.append( (old, new) )
+        moves = unique_moves
+
+        changed = True
+        while changed:
+            changed = False
+            valid = []
+            targets = set()
+            removes = []
+            for old, new in moves:
+                reason = None
+                if new in targets:
+                    reason = "new path is the new path of another rename"
+                elif new not in sources and self._exists(new):
+                    if self.overwrite:
+                        removes.append(new)
+                    else:
+                        reason = "new path already exists"
+                if reason is None:
+                    valid.append( (old, new) )
+                    targets.add(new)
+                else:
+                    self.warnings.append("%s. rename skipped\nold path: %s\nnew path: %s"
+                            % (reason, old, new))
+                    sources.discard(old)
+                    changed = True
+            moves = valid
+        self.removes = removes
+        return moves
+
+    def _tmp_path(self, path):
+        head, bname = os.path.split(path)
+        i = 0
+        while True:
+            tmp = os.path.join(head, self.TMP_FORMAT % (bname, i))
+            if not self._exists(tmp):
+                self._add_exists(tmp)
+                return tmp
+            i += 1
+
+    def _build(self, moves):
+
+        for path in self.removes:
+            self.steps.append( ('rm', path, None) )
+
+        dst_of = dict(moves)
+        position = dict( (old, i) for i, (old, new) in enumerate(moves) )
+        done = set()
+        groups = []
+        for start, _ in moves:
+            if start in done:
+                continue
+
+            #follow the chain until a new path that is free, or freed by
+            #earlier steps, or back to start
+            chain = [start]
+            node = dst_of[start]
+            while node in dst_of and node != start and node not in done:
+                chain.append(node)
+                node = dst_of[node]
+            done.update(chain)
+
+            steps = []
+            if node == start:
+                tmp = self._tmp_path(start)
+                steps.append( ('mv', start, tmp) )
+                for old in reversed(chain[1:]):
+                    steps.append( ('mv', old, dst_of[old]) )
+                steps.append( ('mv', tmp, dst_of[start]) )
+            else:
+                for old in reversed(chain):
+                    steps.append( ('mv', old, dst_of[old]) )
+            #a chain is done at the position of its last member in the input,
+            #so that the children of each of its members, given before them, are moved first
+            groups.append( (max( position[old] for old in chain ), steps) )
+
+        groups.sort(key=lambda group: group[0])
+        for _, steps in groups:
+            self.steps.extend(steps)
+
+    def write_journal(self, journal_path, done=()):
+        """
+        Writes all steps and the done marks of the given step indexes
+        to a new journal, and returns the journal file opened for appending
+        further done marks.
+
+        The journal is written to a temporary path and then renamed,
+        so that an existing journal at journal_path is replaced atomically.
+        """
+        tmp_journal_path = journal_path + '.tmp'
+        journal = open(tmp_journal_path, 'w')
+        for i, (op, src, dst) in enumerate(self.steps):
+            journal.write(json.dumps({'step':i, 'op':op, 'src':src, 'dst':dst}) + '\n')
+        journal.write(json.dumps({'begin':True}) + '\n')
+        for i in sorted(done):
+            journal.write('{"done": %d}\n' % i)
+        journal.flush()
+        os.fsync(journal.fileno())
+        os.rename(tmp_journal_path, journal_path)
+        return journal
+
+    def apply(self, mv_func=os.rename, journal_path=None, done=frozenset(), manifest_path=None):
+        """
+        Applies the steps in order.
+
+        If a step fails, the steps whose new path is its old path,
+        which is therefore still taken, are skipped.
+
+        :param mv_func: function used to rename. same as in files.move.
+            if it has a flush method, such as move_argparse.GitMvBatch,
+            it is called after the last step, and must return a list of error messages.
+        :param journal_path: if given, writes the plan and the progress to
+            a journal at this path.
+        :param done: indexes of steps already done, which are skipped.
+        :param manifest_path: if given, writes a manifest of the renames done
+            for undo_move. it is written to a temporary path, and only replaces
+            the file at manifest_path if at least one rename was done,
+            so that the manifest of the previous batch is not lost otherwise.
+        :returns: list of error messages
+        """
+
+        if journal_path is not None:
+            journal = self.write_journal(journal_path, done)
+        else:
+            journal = None
+        if manifest_path is not None:
+            tmp_manifest_path = manifest_path + '.tmp'
+            manifest = open(tmp_manifest_path, 'w')
+        else:
+            manifest = None
+        renamed = False
+
+        errors = []
+        blocked = set()
+        try:
+            for i, (op, src, dst) in enumerate(self.steps):
+                if i in done:
+                    continue
+                if op == 'mv' and dst in blocked:
+                    errors.append("not renamed because new path was not freed\n%s\n%s"
+                            % (src, dst))
+                    blocked.add(src)
+                    continue
+                try:
+                    if op == 'mv':
+                        mv_func(src, dst)
+                    else:
+                        remove_recursive(src)
+                except Exception, e:
+                    errors.append("os error: could not %s\n%s\n%s\n\n%s"
+                            % ('rename' if op == 'mv' else 'remove', src, dst, e))
+                    blocked.add(src)
+                    continue
+                if journal is not None:
+                    journal.write('{"done": %d}\n' % i)
+                    journal.flush()
+                if manifest is not None and op == 'mv':
+                    try:
+                        ino = os.lstat(dst).st_ino
+                    except OSError:
+                        ino = None
+                    manifest.write(json.dumps({'ino':ino, 'old':src, 'new':dst}) + '\n')
+                    renamed = True
+            flush = getattr(mv_func, 'flush', None)
+            if flush is not None:
+                errors.extend(flush())
+            if journal is not None:
+                journal.write(json.dumps({'end':True}) + '\n')
+        finally:
+            if journal is not None:
+                journal.close()
+            if manifest is not None:
+                manifest.close()
+                if renamed:
+                    os.rename(tmp_manifest_path, manifest_path)
+                else:
+                    os.remove(tmp_manifest_path)
+        return errors
+
+    @classmethod
+    def from_journal(cls, journal_path):
+        """
+        Reads a journal written by apply.
+
+        :returns: (plan, done) where done is the set of indexes of steps
+            that were done. plan is None if the journal was interrupted
+            before all steps were written, in which case no step was applied.
+
+            besides the steps marked as done, the step after the last one marked,
+            which was being applied when a crash happened, is considered done iff
+            its old path does not exist anymore and its new path does.
+
+        Crash after the journal is written, but before the first step of a cycle:
+
+        >>> import tempfile, shutil
+        >>> d = tempfile.mkdtemp()
+        >>> a, b, journal_path = [ os.path.join(d, x) for x in ('a', 'b', 'journal') ]
+        >>> for p in (a, b): open(p, 'w').write(p)
+        >>> MovePlan([ (a, b), (b, a) ]).write_journal(journal_path).close()
+        >>> MovePlan.from_journal(journal_path)[1]
+        set([])
+        >>> resume_move(journal_path)
+        []
+        >>> open(a).read() == b, open(b).read() == a
+        (True, True)
+        >>> shutil.rmtree(d)
+        """
+        steps = []
+        done = set()
+        last_done = -1
+        begun = False
+        with open(journal_path) as journal:
+            for line in journal:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    break #last line truncated by the crash
+                if 'step' in record:
+                    steps.append( (record['op'], record['src'], record['dst']) )
+                elif 'done' in record:
+                    done.add(record['done'])
+                    last_done = record['done']
+                elif 'begin' in record:
+                    begun = True
+        if not begun:
+            return None, done
+        #steps are applied in order, so only the one after the last done can have been in flight
+        i = last_done + 1
+        if i < len(steps) and i not in done:
+            op, src, dst = steps[i]
+            if not os.path.lexists(src) and ( dst is None or os.path.lexists(dst) ):
+                done.add(i)
+        plan = cls.__new__(cls)
+        plan.overwrite = False
+        plan.warnings = []
+        plan.steps = steps
+        return plan, done
+
+def resume_move(journal_path, mv_func=os.rename):
+    """
+    Applies the steps of an interrupted journal which were not yet done.
+
+    The journal is rewritten, with the already done steps marked.
+
+    :returns: list of error messages
+    """
+    plan, done = MovePlan.from_journal(journal_path)
+    if plan is None:
+        logging.info("journal was interrupted before any rename: nothing to resume")
+        return []
+    return plan.apply(mv_func, journal_path=journal_path, done=done)
+
+def rollback_move(journal_path, mv_func=os.rename):
+    """
+    Undoes the steps of a journal which were done, last first.
+
+    Removals cannot be undone: an error message is given for each of them.
+
+    Afterwards the journal contains the steps of the rollback,
+    so rolling back again redoes the original renames.
+
+    :returns: list of error messages
+    """
+    plan, done = MovePlan.from_journal(journal_path)
+    if plan is None:
+        return []
+    errors = []
+    steps = []
+    for i in sorted(done, reverse=True):
+        op, src, dst = plan.steps[i]
+        if op == 'mv':
+            steps.append( ('mv', dst, src) )
+        else:
+            errors.append("cannot undo removal of:\n%s" % src)
+    plan.steps = steps
+    return errors + plan.apply(mv_func, journal_path=journal_path)
+
+def read_manifest(manifest_path):
+    """
+    Reads a manifest written by MovePlan.apply.
+
+    Renames of a same file, such as those through temporary names that break cycles,
+    are merged into one.
+
+    :returns: list of (inode, original path, current path) of the renamed files,
+        in the order in which they were renamed
+    """
+    current = collections.OrderedDict()
+    with open(manifest_path) as manifest:
+        for line in manifest:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                break #last line truncated by a crash
+            original, ino = current.pop(record['old'], (record['old'], record['ino']))
+            current[record['new']] = (original, ino)
+    return [ (ino, original, path) for path, (original, ino)
+            in current.iteritems() if original != path ]
+
+class _InodeCheckedMv(object):
+    """
+    mv_func that only renames paths which still have the inode they had in a manifest.
+    """
+
+    def __init__(self, mv_func, inodes):
+        self.mv_func = mv_func
+        self.inodes = inodes
+        flush = getattr(mv_func, 'flush', None)
+        if flush is not None:
+            self.flush = flush
+
+    def __call__(self, src, dst):
+        ino = self.inodes.get(src)
+        if ino is not None and os.lstat(src).st_ino != ino:
+            raise OSError("path is not the renamed file anymore: its inode changed")
+        self.mv_func(src, dst)
+
+def undo_move(manifest_path, mv_func=os.rename, do_move=True):
+    """
+    Undoes the renames of a manifest as a single batch, last renamed first.
+
+    Before renaming each file back, checks that its path still has the inode
+    it had after the rename, so that files which were replaced meanwhile are not touched.
+
+    Once all is done, the manifest is replaced by that of the undo,
+    so undoing again redoes the original renames.
+
+    :param do_move: if False, only returns the problems found when planning the undo.
+    :returns: list of error messages
+
+    >>> import tempfile, shutil
+    >>> d = tempfile.mkdtemp()
+    >>> a, b, c, manifest = [ os.path.join(d, x) for x in ('a', 'b', 'c', 'manifest') ]
+    >>> for p in (a, b): open(p, 'w').write(p)
+    >>> MovePlan([ (a, b), (b, c) ]).apply(manifest_path=manifest)
+    []
+    >>> [ (os.path.basename(old), os.path.basename(new)) for (ino, old, new) in read_manifest(manifest) ] == [('b', 'c'), ('a', 'b')]
+    True
+    >>> undo_move(manifest)
+    []
+    >>> open(a).read() == a, open(b).read() == b, os.path.exists(c)
+    (True, True, False)
+
+    A batch without renames keeps the manifest of the previous one:
+
+    >>> MovePlan([]).apply(manifest_path=manifest)
+    []
+    >>> len(read_manifest(manifest))
+    2
+    >>> shutil.rmtree(d)
+    """
+    records = read_manifest(manifest_path)
+    moves = [ (path, original) for (ino, original, path) in reversed(records) ]
+    inodes = dict( (path, ino) for (ino, original, path) in records )
+    plan = MovePlan(moves)
+    errors = list(plan.warnings)
+    if do_move:
+        errors.extend(plan.apply(_InodeCheckedMv(mv_func, inodes), manifest_path=manifest_path))
+    return errors
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
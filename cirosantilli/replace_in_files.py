@@ -0,0 +1,272 @@
+#!/usr/bin/env python
+
+"""
+Regex find and replace in many files, used by replace_in_files_regex.py.
+
+Each file is processed independently, either linewise, where the regex is applied
+to each line without its newline, or multiline, where it is applied to the entire file.
+
+The result of each file is a report of the changes: for linewise mode,
+the line number, old line and new line of each changed line; for multiline mode,
+the line number, old text and new text of each changed match.
+
+In multiline mode the file is memory mapped and the regex runs directly on the mapping,
+and the new file is written while matches are found, so files much larger than memory
+can be processed.
+
+Before a file is read, it is memory mapped and its raw bytes are searched
+for the literal substrings that any match must contain, see utils.required_literals,
+and for a null byte near its start, which indicates a binary file.
+Most files of a tree have no match, and are therefore rejected without being read line by line.
+
+Files can be processed in parallel by a pool of processes. Reports are
+still yielded in the order of the input paths, so they can be written by a single writer.
+"""
+
+import mmap
+import multiprocessing
+import re
+
+import files
+import utils
+
+LINE_NUMBER_SEPARATOR = ' ' * 2
+REPORT_SEPARATOR = '=' * 70
+
+#a null byte in this many first bytes means that the file is binary, as for grep and git
+BINARY_CHECK_SIZE = 8000
+
+#maximum size of the copies of the unchanged parts of files in multiline mode
+COPY_CHUNK_SIZE = 2**20
+
+def _chomp(s):
+    if s and s[-1] == '\n':
+        return s[:-1]
+    else:
+        return s
+
+def may_match(path, literals=(), skip_binary=True):
+    """
+    Returns False if the file at path cannot match a regex whose matches contain all literals,
+    or if it is binary and skip_binary.
+
+    The file is memory mapped, so the search runs on the page cache without copying it.
+
+    :raises: IOError
+    """
+    with open(path, 'rb') as f:
+        try:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            return not literals #empty file: only regexes that match the empty string match it
+        except EnvironmentError:
+            return True #cannot be mapped, e.g. a pipe: let the regex decide
+        try:
+            if skip_binary and data.find('\0', 0, BINARY_CHECK_SIZE) != -1:
+                return False
+            for literal in literals:
+                if data.find(literal) == -1:
+                    return False
+            return True
+        finally:
+            data.close()
+
+def _copy(data, start, end, writer):
+    """
+    Writes data[start:end] to writer if not None, without copying it all at once.
+
+    :returns: number of newlines in data[start:end]
+    """
+    newlines = 0
+    for chunk_start in xrange(start, end, COPY_CHUNK_SIZE):
+        chunk = data[chunk_start:min(end, chunk_start + COPY_CHUNK_SIZE)]
+        newlines += chunk.count('\n')
+        if writer is not None:
+            writer.write(chunk)
+    return newlines
+
+def _copy_prefix(path, size, writer):
+    """Writes the first size bytes of the file at path to writer, without reading them all at once."""
+    with open(path, 'rb') as f:
+        while size > 0:
+            chunk = f.read(min(size, COPY_CHUNK_SIZE))
+            if not chunk:
+                break
+            writer.write(chunk)
+            size -= len(chunk)
+
+def _replace_multiline(data, regex, replace, new_writer, report):
+    """
+    Replaces all matches of regex in data, which may be a memory mapped file,
+    like regex.sub, but writes the result to a writer while matches are found
+    instead of building it in memory.
+
+    A final newline is not part of the searched string, as in linewise mode.
+
+    :param new_writer: function that returns a file like object where the new data is written,
+        only called once the first change is found. if None, nothing is written.
+    :param report: list where report lines of the changed matches are appended
+    :returns: the writer, or None if there were no changes or new_writer is None
+    """
+    writer = None
+    end = len(data)
+    if end and data[end - 1] == '\n':
+        end -= 1
+    last = 0
+    line = 0
+    previous_end = None
+    for match in regex.finditer(data, 0, end):
+        start, stop = match.span()
+        if start == stop == previous_end:
+            continue #as re.sub, ignore empty matches adjacent to the previous match
+        previous_end = stop
+        old = match.group()
+        new = match.expand(replace)
+        if new == old:
+            continue
+        if writer is None and new_writer is not None:
+            writer = new_writer()
+        line += _copy(data, last, start, writer)
+        report.append("%i%s%s\n%i%s%s\n" % (
+            line, LINE_NUMBER_SEPARATOR, old, line, LINE_NUMBER_SEPARATOR, new))
+        if writer is not None:
+            writer.write(new)
+        line += old.count('\n')
+        last = stop
+    if report:
+        _copy(data, last, len(data), writer)
+    return writer
+
+def replace_in_file(path, regex, replace, multiline=False, do_write=False,
+        literals=None, skip_binary=True):
+    """
+    Replaces the matches of regex in the file at path.
+
+    :param regex: compiled regex to find
+    :param replace: replacement, as for re.sub
+    :param multiline: if True, acts on the entire file. else acts on each line.
+    :param do_write: if True and there are changes, the file is modified.
+        else, only the report is made.
+    :param literals: substrings that all matches contain, used to skip files
+        without reading them. default: utils.required_literals of regex.
+    :param skip_binary: if True, binary files are skipped.
+    :returns: report of the changes, or the empty string if there are none
+    :raises: IOError, or OSError if the new file cannot be created
+
+    >>> import tempfile
+    >>> f = tempfile.NamedTemporaryFile()
+    >>> f.write('a1\\nb\\na2\\n')
+    >>> f.flush()
+    >>> print replace_in_file(f.name, re.compile(r'a(\\d)'), r'c\\1', do_write=True).replace(f.name, 'PATH'),
+    <BLANKLINE>
+    ======================================================================
+    PATH
+    <BLANKLINE>
+    0  a1
+    0  c1
+    2  a2
+    2  c2
+    >>> open(f.name).read()
+    'c1\\nb\\nc2\\n'
+    >>> print replace_in_file(f.name, re.compile(r'1\\nb', re.M), r'3', multiline=True).replace(f.name, 'PATH'),
+    <BLANKLINE>
+    ======================================================================
+    PATH
+    <BLANKLINE>
+    0  1
+    b
+    0  3
+    """
+    if literals is None:
+        literals = utils.required_literals(regex.pattern, regex.flags)
+    if ( literals or skip_binary ) and not may_match(path, literals, skip_binary):
+        return ''
+    report = []
+    #new data is streamed to a new file, which is only created once a change is found,
+    #so that unchanged files can be in directories where it cannot be created
+    new_writer = ( lambda: files.AtomicWriter(path) ) if do_write else None
+    writer = None
+    with open(path, 'r') as f:
+        try:
+            if multiline:
+                try:
+                    data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                except (ValueError, EnvironmentError):
+                    data = f.read() #empty file or cannot be mapped
+                try:
+                    writer = _replace_multiline(data, regex, replace, new_writer, report)
+                finally:
+                    if isinstance(data, mmap.mmap):
+                        data.close()
+            else:
+                offset = 0
+                for i, old_line in enumerate(f):
+                    line_size = len(old_line)
+                    old_line = _chomp(old_line)
+                    new_line = regex.sub(replace, old_line)
+                    if new_line != old_line:
+                        report.append("%i%s%s\n%i%s%s\n" % (
+                            i, LINE_NUMBER_SEPARATOR, old_line, i, LINE_NUMBER_SEPARATOR, new_line))
+                        if writer is None and new_writer is not None:
+                            writer = new_writer()
+                            _copy_prefix(path, offset, writer)
+                    if writer is not None:
+                        writer.write(new_line)
+                        writer.write('\n')
+                    offset += line_size
+        except:
+            if writer is not None:
+                writer.discard()
+            raise
+        if writer is not None:
+            writer.commit()
+    if not report:
+        return ''
+    return '\n%s\n%s\n\n%s' % (REPORT_SEPARATOR, path, ''.join(report))
+
+_job = None
+
+def _init_worker(pattern, flags, replace, multiline, do_write, skip_binary):
+    global _job
+    _job = (re.compile(pattern, flags), replace, multiline, do_write,
+            utils.required_literals(pattern, flags), skip_binary)
+
+def _replace_in_file_job(path):
+    try:
+        return path, replace_in_file(path, *_job), None
+    except EnvironmentError, e:
+        return path, '', e
+
+def replace_in_files(paths, regex, replace, multiline=False, do_write=False,
+        workers=1, chunksize=16, skip_binary=True):
+    """
+    Yields (path, report, error) for each path, in the order of paths.
+
+    report is that of replace_in_file. If the file could not be read or written,
+    report is empty and error is the IOError or OSError, else error is None.
+    Other files are still processed.
+
+    :param regex: compiled regex to find
+    :param workers: number of processes that process files in parallel.
+        if 1, all is done in the current process.
+    :param chunksize: number of paths sent to a worker process at once
+    :param skip_binary: see replace_in_file
+    """
+    init_args = (regex.pattern, regex.flags, replace, multiline, do_write, skip_binary)
+    if workers <= 1:
+        _init_worker(*init_args)
+        for path in paths:
+            yield _replace_in_file_job(path)
+        return
+    pool = multiprocessing.Pool(workers, _init_worker, init_args)
+    try:
+        for result in pool.imap(_replace_in_file_job, paths, chunksize):
+            yield result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -2,6 +2,8 @@
 
 import re
 import os.path
+import sre_constants
+import sre_parse
 
 STDERR_SEPARATOR0 = '=' * 60
 
@@ -26,12 +28,141 @@ def resub(resubpair,target):
 
 def resubs(resubpairs,target):
     """takes several regex find replace pairs [(find1, replace1), (find2,replace2), ... ]
-    and applies them to a target on the order given"""
-    return resubpair[0].sub(resubpair[1],target)
+    and applies them to a target on the order given
+
+    to apply the same pairs to many targets, ResubPipeline is faster.
+
+    >>> resubs([(re.compile('a'), 'b'), (re.compile('b'), 'c')], 'ab')
+    'cc'
+    """
     for resubpair in resubpairs:
         target = resub(resubpair,target)
     return target
 
+def _uses_group_references(regex):
+    """
+    True iff the compiled regex has named groups or backreferences,
+    whose meaning would change if it were merged with other regexes.
+    """
+    if regex.groupindex:
+        return True
+    stack = [ sre_parse.parse(regex.pattern, regex.flags) ]
+    while stack:
+        item = stack.pop()
+        if isinstance(item, sre_parse.SubPattern):
+            for op, av in item:
+                if op in (sre_constants.GROUPREF, sre_constants.GROUPREF_EXISTS):
+                    return True
+                stack.append(av)
+        elif isinstance(item, (list, tuple)):
+            stack.extend(item)
+    return False
+
+class ResubPipeline(object):
+    """
+    Compiled sequence of regex substitutions to apply to many strings.
+
+    :param stages: stages applied in order. each stage is either:
+
+        - a (regex, replace) pair, as for resub. regex may be compiled or a string.
+        - a list of such pairs, which are merged into one regex with one named group per pair,
+            so that the string is scanned only once for all of them.
+            each match is replaced according to the pair whose group matched,
+            looked up in a dispatch table.
+
+            at each position, the first pair whose regex matches is used,
+            so the result is the same as that of applying the pairs in sequence
+            if matches of different pairs do not overlap, and replacements
+            do not create new matches. this is the case of most cleanup rules,
+            such as removing leading whitespace and squeezing inner whitespace.
+
+            the regexes of a merged stage must have the same flags.
+
+            regexes with named groups or backreferences cannot be merged,
+            since group names and numbers would conflict in the merged regex,
+            so a list that contains any of them is applied in sequence instead.
+
+    >>> pipeline = ResubPipeline([
+    ...     [ (r'^[-\\s]+', ''), (r'\\s+$', ''), (r'\\s+', ' ') ],
+    ...     (r'(\\w+)\\.(\\w+)', r'\\2.\\1'),
+    ... ])
+    >>> pipeline.sub(' - a  b.c  ')
+    'a c.b'
+    >>> pipeline.sub_all(['  a', 'b.c'])
+    ['a', 'c.b']
+    >>> ResubPipeline([ [ (r'(a)(b)', r'\\2\\1'), (r'(c)', r'\\1\\1') ] ]).sub('abc')
+    'bacc'
+    >>> ResubPipeline([ [ (r'(o)\\1', 'O'), (r'(x)', r'[\\1]') ] ]).sub('foox')
+    'fO[x]'
+    >>> ResubPipeline([ [ (r'(?P<w>a)', r'\\g<w>\\g<w>'), (r'(?P<w>b)', '') ] ]).sub('ab')
+    'aa'
+    """
+
+    def __init__(self, stages):
+        self.stages = []
+        for stage in stages:
+            if isinstance(stage[0], (list, tuple)):
+                pairs = [ (self._compile(regex), replace) for (regex, replace) in stage ]
+            else:
+                pairs = [ (self._compile(stage[0]), stage[1]) ]
+            if len(pairs) == 1 or any( _uses_group_references(regex) for regex, replace in pairs ):
+                self.stages.extend( (regex.sub, replace) for regex, replace in pairs )
+            else:
+                self.stages.append( self._merge(pairs) )
+
+    @staticmethod
+    def _compile(regex):
+        if isinstance(regex, basestring):
+            return re.compile(regex)
+        return regex
+
+    @staticmethod
+    def _merge(pairs):
+        flags = set( regex.flags for regex, replace in pairs )
+        if len(flags) != 1:
+            raise ValueError("the regexes of a merged stage must have the same flags")
+        regex = re.compile(
+                '|'.join( '(?P<_%d>%s)' % (i, pair_regex.pattern)
+                        for i, (pair_regex, replace) in enumerate(pairs) ),
+                flags.pop())
+        #literal replacements are used as is.
+        #others are expanded on a match of the pair regex alone, at the same position,
+        #so that their group numbers are those of the pair regex.
+        table = {}
+        for i, (pair_regex, replace) in enumerate(pairs):
+            if callable(replace) or '\\' in replace:
+                table['_%d' % i] = (None, pair_regex, replace)
+            else:
+                table['_%d' % i] = (replace, None, None)
+        def dispatch(match):
+            literal, pair_regex, replace = table[match.lastgroup]
+            if pair_regex is None:
+                return literal
+            pair_match = pair_regex.match(match.string, match.start())
+            if callable(replace):
+                return replace(pair_match)
+            return pair_match.expand(replace)
+        return (regex.sub, dispatch)
+
+    def sub(self, target):
+        """Applies all stages to target."""
+        for sub, replace in self.stages:
+            target = sub(replace, target)
+        return target
+
+    __call__ = sub
+
+    def sub_all(self, targets):
+        """Returns the list of the results of sub for each of targets."""
+        stages = self.stages
+        results = []
+        append = results.append
+        for target in targets:
+            for sub, replace in stages:
+                target = sub(replace, target)
+            append(target)
+        return results
+
 whitespaces_to_single_space_resub = [re.compile(r"\s+")," "]
 def whitespaces_to_single_space(s):
     return resub(whitespaces_to_single_space_resub,s)
@@ -44,6 +175,209 @@ remove_trailling_whitespace_resub = [re.compile(r"\s+$"),""]
 def remove_trailling_whitespace(s):
     return resub(remove_trailling_whitespace_resub,s)
 
+def _is_ascii(s):
+    try:
+        if isinstance(s, unicode):
+            s.encode('ascii')
+        else:
+            s.decode('ascii')
+    except UnicodeError:
+        return False
+    return True
+
+class RegexAllMatcher(object):
+    """
+    Tests if strings match all of some regexes and none of others,
+    with a single regex call per string.
+
+    The regexes are combined into one lookahead per regex:
+
+        ^(?=[\s\S]*?(?:find0))(?=[\s\S]*?(?:find1))(?![\s\S]*?(?:negated0))
+
+    which gives the same result as one search per regex.
+
+    If no regex uses metacharacters, plain substring tests are used instead,
+    which are faster than any regex. When ignoring case, only for ascii regexes
+    and strings, for which lower folds case exactly as the regex does.
+
+    Regexes with groups are searched separately, since group numbers and names
+    would conflict in the combined regex.
+
+    :param patterns: the regexes which must all match
+    :type patterns: list of strings
+    :param negated: the regexes which must not match
+    :type negated: list of strings
+    :param flags: re flags of all the regexes
+
+    >>> m = RegexAllMatcher(['ab', 'cd'], ['ef'], re.IGNORECASE)
+    >>> m.accepts('0aB1cD'), m.accepts('0ab'), m.accepts('abcdef')
+    (True, False, False)
+    >>> m.spans('abcdab')
+    [(0, 2), (4, 6), (2, 4)]
+    >>> m = RegexAllMatcher(['a.', '^c'])
+    >>> m.accepts('cab'), m.accepts('bca')
+    (True, False)
+    >>> m = RegexAllMatcher([u's'], flags=re.IGNORECASE | re.UNICODE)
+    >>> m.accepts(u'S'), m.accepts(u'\u017f'), m.accepts(u'\xe9')
+    (True, True, False)
+    """
+
+    def __init__(self, patterns, negated=(), flags=0):
+        self.patterns = list(patterns)
+        self.negated = list(negated)
+        self.flags = flags
+        self.ignorecase = bool(flags & re.IGNORECASE)
+        self.res = [ re.compile(pattern, flags) for pattern in self.patterns ]
+        negated_res = [ re.compile(pattern, flags) for pattern in self.negated ]
+
+        self.negated_res = negated_res
+
+        literals = map(self._literal, self.patterns + self.negated)
+        if self.ignorecase and not all( literal is not None and _is_ascii(literal)
+                for literal in literals ):
+            #lower does not fold case as the regex does for some non ascii chars
+            literals = [None]
+        if None not in literals:
+            if self.ignorecase:
+                literals = [ literal.lower() for literal in literals ]
+            self.literals = literals[:len(self.patterns)]
+            self.negated_literals = literals[len(self.patterns):]
+            self.accepts = self._accepts_literals
+        elif any( regex.groups for regex in self.res + negated_res ):
+            self.accepts = self._accepts_separately
+        else:
+            self.regex = re.compile(
+                    '^' +
+                    ''.join( '(?=[\\s\\S]*?(?:%s))' % pattern for pattern in self.patterns ) +
+                    ''.join( '(?![\\s\\S]*?(?:%s))' % pattern for pattern in self.negated ),
+                    flags)
+            self.accepts = self._accepts_combined
+
+    @staticmethod
+    def _literal(pattern):
+        """returns the string matched by pattern if it has no metacharacters, else None"""
+        to_char = unichr if isinstance(pattern, unicode) else chr
+        chars = []
+        for op, av in sre_parse.parse(pattern):
+            if op != sre_constants.LITERAL:
+                return None
+            chars.append(to_char(av))
+        return type(pattern)().join(chars)
+
+    def _accepts_literals(self, s):
+        if self.ignorecase:
+            if not _is_ascii(s):
+                #e.g. u'\u017f' matches 's' when ignoring case, but is its own lower case
+                return self._accepts_separately(s)
+            s = s.lower()
+        for literal in self.literals:
+            if literal not in s:
+                return False
+        for literal in self.negated_literals:
+            if literal in s:
+                return False
+        return True
+
+    def _accepts_combined(self, s):
+        return self.regex.match(s) is not None
+
+    def _accepts_separately(self, s):
+        for regex in self.res:
+            if not regex.search(s):
+                return False
+        for regex in self.negated_res:
+            if regex.search(s):
+                return False
+        return True
+
+    def spans(self, s):
+        """
+        Returns the (start, end) spans of all the matches of all the regexes that must match.
+
+        Spans of different regexes may overlap.
+        Meant to be called only on accepted strings, for example to color them.
+        """
+        return [ match.span() for regex in self.res for match in regex.finditer(s) ]
+
+def required_literals(pattern, flags=0):
+    """
+    Returns substrings that every match of the regex pattern contains, longest first.
+
+    Useful to quickly reject strings or files that cannot match before running the regex,
+    with a fast substring search.
+
+    Only literal characters outside of alternations and optional repetitions are considered,
+    so the list may be empty even if the regex requires some characters.
+    It is always empty with re.IGNORECASE or re.LOCALE, since matches may have another case.
+
+    >>> required_literals(r'ab(c|d)e+f(gh)?(ij){2}')
+    ['ab', 'ij', 'e', 'f']
+    >>> required_literals(r'^foo\.bar$|baz')
+    []
+    >>> required_literals(r'ab', re.IGNORECASE)
+    []
+    """
+    if flags & (re.IGNORECASE | re.LOCALE):
+        return []
+    parsed = sre_parse.parse(pattern, flags)
+    if parsed.pattern.flags & (re.IGNORECASE | re.LOCALE): #inline flags such as (?i)
+        return []
+    to_char = unichr if isinstance(pattern, unicode) else chr
+    literals = []
+    def walk(subpattern):
+        run = []
+        for op, av in subpattern:
+            if op == sre_constants.LITERAL:
+                run.append(to_char(av))
+                continue
+            if run:
+                literals.append(type(pattern)().join(run))
+                run = []
+            if op == sre_constants.SUBPATTERN:
+                walk(av[-1])
+            elif op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT) and av[0] >= 1:
+                walk(av[2])
+        if run:
+            literals.append(type(pattern)().join(run))
+    walk(parsed)
+    unique = []
+    for literal in literals:
+        if literal not in unique:
+            unique.append(literal)
+    return sorted(unique, key=len, reverse=True)
+
+def merge_spans(spans):
+    """
+    Sorts (start, end) spans and merges those that overlap or touch.
+
+    >>> merge_spans([(4, 6), (0, 2), (1, 3), (3, 4), (8, 9)])
+    [(0, 6), (8, 9)]
+    """
+    merged = []
+    for start, end in sorted(spans):
+        if merged and start <= merged[-1][1]:
+            if end > merged[-1][1]:
+                merged[-1] = (merged[-1][0], end)
+        else:
+            merged.append( (start, end) )
+    return merged
+
+def highlight_spans(s, spans, before, after):
+    """
+    Returns s with before and after inserted around each of the merged spans,
+    for example the terminal escape sequences that start and end a color.
+
+    >>> highlight_spans('abcdef', [(3, 5), (0, 1), (4, 6)], '[', ']')
+    '[a]bc[def]'
+    """
+    parts = []
+    last = 0
+    for start, end in merge_spans(spans):
+        parts.extend( (s[last:start], before, s[start:end], after) )
+        last = end
+    parts.append(s[last:])
+    return ''.join(parts)
+
 CONTROL_CHARS_STR = u''.join(map(unichr, range(0,32) + range(127,160)))
 CONTROL_CHAR_RE = re.compile('[%s]' % re.escape(CONTROL_CHARS_STR), re.UNICODE)
 def strip_control_chars(s):